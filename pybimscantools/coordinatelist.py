@@ -4,20 +4,26 @@ import os
 import matplotlib.pyplot as plt
 import numpy as np
 import simplekml
-from swissreframe import initialize_reframe
 
+from pybimscantools import kmlwriter
+from pybimscantools import reframe
 from pybimscantools import textcolor
 from pybimscantools import transformations
 from pybimscantools import helper
 
 
+# initial number of coordinates the array of a CoordinateList has room for
+INITIAL_CAPACITY = 16
+
+
 class CoordinateList:
     """
-    CoordinateList class containing a list of coordinates
+    CoordinateList class containing a list of coordinates stored as a contiguous Nx3 array
     """
 
     def __init__(self, coordinates: list = None, altitude: float = None) -> None:
-        self.__coordinates = []
+        self.__coordinates = np.empty((INITIAL_CAPACITY, 3))
+        self.__size = 0
         self.__height = 0
         if coordinates is not None and altitude is None:
             self.extend(coordinates)
@@ -28,7 +34,7 @@ class CoordinateList:
         """
         Return the i-th entry of the CoordinateList
         """
-        return self.__coordinates[i]
+        return self.get_array()[i].tolist()
 
     def copy(self) -> 'CoordinateList':
         """
@@ -36,36 +42,55 @@ class CoordinateList:
         """
         return copy.deepcopy(self)
 
+    def reserve(self, capacity: int) -> None:
+        """
+        Grow the array so that it has room for at least capacity coordinates
+        """
+        if capacity > len(self.__coordinates):
+            coordinates = np.empty((max(capacity, 2 * len(self.__coordinates)), 3))
+            coordinates[:self.__size] = self.__coordinates[:self.__size]
+            self.__coordinates = coordinates
+
     def append(self, coordinate: list) -> None:
         """
         Append a coordinate to the end of the CoordinateList
         """
-        self.__coordinates.append(coordinate)
+        self.__detach()
+        self.reserve(self.__size + 1)
+        self.__coordinates[self.__size] = coordinate
+        self.__size += 1
 
     def pop(self) -> None:
         """
         Pop a coordinate from the end of the list
         """
-        self.__coordinates.pop()
+        if self.__size == 0:
+            raise IndexError("pop from empty CoordinateList")
+        self.__detach()
+        self.__size -= 1
 
     def extend(self, coordinates: list) -> None:
         """
-        Extend the CoordinateList with a list of coordinates
+        Extend the CoordinateList with a list or a Nx3 array of coordinates
         """
-        self.__coordinates.extend(coordinates)
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+        self.__detach()
+        self.reserve(self.__size + len(coordinates))
+        self.__coordinates[self.__size:self.__size + len(coordinates)] = coordinates
+        self.__size += len(coordinates)
 
     def extend_2d(self, coordinates_2d: list, altitude: float = 0) -> None:
         """
         Extend a CoordinateList with a 2d list of coordinates
         """
-        for coordinate_2d in coordinates_2d:
-            self.append([coordinate_2d[0], coordinate_2d[1], altitude])
+        coordinates_2d = np.asarray(coordinates_2d, dtype=np.float64).reshape(-1, 2)
+        self.extend(np.column_stack((coordinates_2d, np.full(len(coordinates_2d), altitude, dtype=np.float64))))
 
     def len(self) -> int:
         """
         Return the number of coordinates in the list
         """
-        return len(self.__coordinates)
+        return self.__size
 
     def last_idx(self) -> int:
         """
@@ -77,7 +102,44 @@ class CoordinateList:
         """
         Return the i-th entry of the CoordinateList
         """
-        return self.__coordinates[i]
+        return self.get_array()[i].tolist()
+
+    def get_array(self) -> np.array:
+        """
+        Return the coordinates as a Nx3 array, the array is a view on the CoordinateList
+        """
+        return self.__coordinates[:self.__size]
+
+    def bind_array(self, coordinates: np.array) -> None:
+        """
+        Use the Nx3 array as the coordinates of the CoordinateList without copying it, the CoordinateList
+        copies the coordinates into an array of its own before it changes them (used by CoordinateModel)
+        """
+        self.__coordinates = coordinates
+        self.__size = len(coordinates)
+
+    def __detach(self) -> None:
+        """
+        Copy the coordinates into an array of its own if they are a view on an array shared with others
+        """
+        if self.__coordinates.base is not None:
+            coordinates = np.empty((max(self.__size, INITIAL_CAPACITY), 3))
+            coordinates[:self.__size] = self.__coordinates[:self.__size]
+            self.__coordinates = coordinates
+
+    def __get_own_array(self) -> np.array:
+        """
+        Return the coordinates as a Nx3 array that is not shared with others and can be changed in place
+        """
+        self.__detach()
+        return self.get_array()
+
+    def set_array(self, coordinates: np.array) -> None:
+        """
+        Replace the coordinates of the CoordinateList by a Nx3 array
+        """
+        self.__size = 0
+        self.extend(coordinates)
 
     def set_height(self, height: float) -> None:
         """
@@ -101,52 +163,40 @@ class CoordinateList:
         """
         Transform the CoordinateList from lv95 to google earth
         """
-        coordinates_copy = self.copy()
+        altitudes = self.get_array()[:, 2] + self.__height
         self.transform_from_lv95_to_etrf93_geographic()
-        # copy 3rd coloumn of coordinates_copy into 3rd column of coordinates
-        for i in range(0, self.len()):
-            self.__coordinates[i] = (self.__coordinates[i][0],
-                                     self.__coordinates[i][1],
-                                     coordinates_copy.__coordinates[i][2] + self.__height)
+        # replace the 3rd column of the transformed coordinates by the altitudes
+        self.__get_own_array()[:, 2] = altitudes
 
     def apply_transformation_matrix(self, t: list) -> None:
         """
         Apply a transformation matrix to the CoordinateList
         """
-        r = t[0:3, 0:3]
-        p = t[0:3, 3]
-        for i in range(len(self.__coordinates)):
-            self.__coordinates[i] = r.dot(self.__coordinates[i]) + p
+        transformations.apply_transformation_to_points(self.__get_own_array(), t, in_place=True)
 
     def transform_from_lv95_to_etrf93_geographic(self) -> None:
         """ 
         Apply lv95 to etrf93 geographic transformation to the
         CoordinateList using swissreframe 
         """
-        swiss_ref = initialize_reframe()
-        for i in range(len(self.__coordinates)):
-            self.__coordinates[i] = swiss_ref.compute_gpsref(self.__coordinates[i],
-                                                             'lv95_to_etrf93_geographic')
+        coordinates = self.__get_own_array()
+        coordinates[:] = reframe.transform_coordinates(coordinates, reframe.LV95_TO_ETRF93_GEOGRAPHIC)
 
     def transform_from_lv95_to_etrf93_geocentric(self) -> None:
         """
         Apply lv95 to etrf93 geocentric transformation to the 
         CoordinateList using swissreframe
         """
-        swiss_ref = initialize_reframe()
-        for i in range(len(self.__coordinates)):
-            self.__coordinates[i] = swiss_ref.compute_gpsref(self.__coordinates[i],
-                                                             'lv95_to_etrf93_geocentric')
+        coordinates = self.__get_own_array()
+        coordinates[:] = reframe.transform_coordinates(coordinates, reframe.LV95_TO_ETRF93_GEOCENTRIC)
 
     def transform_from_etrf93_geographic_to_lv95(self) -> None:
         """
         Apply etrf93 geographic to lv95 transformation to the 
         CoordinateList using swissreframe
         """
-        swiss_ref = initialize_reframe()
-        for i in range(len(self.__coordinates)):
-            self.__coordinates[i] = swiss_ref.compute_gpsref(self.__coordinates[i],
-                                                             'etrf93_gepgraphic_to_lv95')
+        coordinates = self.__get_own_array()
+        coordinates[:] = reframe.transform_coordinates(coordinates, reframe.ETRF93_GEOGRAPHIC_TO_LV95)
 
     # apply etrf93 geocentric to lv95 transformation to the CoordinateList using swissreframe
     def transform_from_etrf93_geocentric_to_lv95(self) -> None:
@@ -154,17 +204,15 @@ class CoordinateList:
         Apply etrf93 geocentric to lv95 transformation to the 
         CoordinateList using swissreframe
         """
-        swiss_ref = initialize_reframe()
-        for i in range(len(self.__coordinates)):
-            self.__coordinates[i] = swiss_ref.compute_gpsref(self.__coordinates[i],
-                                                             'etrf93_geocentric_to_lv95')
+        coordinates = self.__get_own_array()
+        coordinates[:] = reframe.transform_coordinates(coordinates, reframe.ETRF93_GEOCENTRIC_TO_LV95)
 
     def print(self) -> None:
         """
         Print the CoordinateList
         """
-        for i in range(len(self.__coordinates)):
-            print(self.__coordinates[i])
+        for coordinate in self.get_array().tolist():
+            print(coordinate)
 
     def plot_coordinates(self, color: str = 'b', marker: str = 'o') -> None:
         """
@@ -177,9 +225,8 @@ class CoordinateList:
         ax.set_box_aspect([1.0, 1.0, 1.0])
 
         # extract the x, y and z values from the converted coordinates
-        ax.scatter([x[0] for x in self.__coordinates],
-                   [y[1] for y in self.__coordinates],
-                   [z[2] for z in self.__coordinates], c=color, marker=marker)
+        coordinates = self.get_array()
+        ax.scatter(coordinates[:, 0], coordinates[:, 1], coordinates[:, 2], c=color, marker=marker)
 
         x_limits = ax.get_xlim3d()
         y_limits = ax.get_ylim3d()
@@ -278,7 +325,7 @@ class CoordinateList:
         Applies the transformation matrix from points for transformation
         """
         self.apply_transformation_matrix(
-            transformations.get_transformation_matrix_from_points_from_xlsx(
+            transformations.read_transformation_matrix_from_points_from_xlsx(
                 path, file_name))
 
     def create_kml_polygon_from_coordinates(self, kml: simplekml.Kml,
@@ -289,9 +336,10 @@ class CoordinateList:
         """
         polygon = kml.newpolygon(name=file_name)
 
-        self.append(self.get_coordinate(0))
-        polygon.outerboundaryis = self.__coordinates
-        self.pop()
+        # close the ring without changing the CoordinateList
+        ring = self.get_array().tolist()
+        ring.append(ring[0])
+        polygon.outerboundaryis = ring
 
         polygon.extrude = 1  # set extrude to 1 to enable extrusion
         polygon.altitudemode = simplekml.AltitudeMode.absolute  # set the altitude mode to absolute
@@ -303,15 +351,11 @@ class CoordinateList:
                                     file_name: str,
                                     hex_color_idx: int = 0) -> None:
         """
-        Create a kml file for google earth from the CoordinateList
+        Create a kml or kmz file for google earth from the CoordinateList
         """
         path = helper.create_subdir_if_not_exists(os.path.join(path, "models"), "kml")
 
-        # create a new KML object
-        kml = simplekml.Kml()
-
-        # create a polygon with the defined points and extrude it
-        self.create_kml_polygon_from_coordinates(kml, os.path.splitext(file_name)[0], hex_color_idx)
-
-        # save the KML file
-        kml.save(os.path.join(path, file_name))
\ No newline at end of file
+        # stream the polygon with the defined points into the KML file
+        with kmlwriter.KmlWriter(os.path.join(path, file_name)) as writer:
+            writer.write_polygon(os.path.splitext(file_name)[0], self.get_array(),
+                                 textcolor.HEX_COLOR_LIST[hex_color_idx])
@@ -1,18 +1,24 @@
-import copy
 import os
 
-import simplekml
+import numpy as np
 
 from pybimscantools import coordinatelist as cl
 from pybimscantools import helper
+from pybimscantools import kmlwriter
+from pybimscantools import reframe
+from pybimscantools import transformations
 
 class CoordinateModel:
     """
-    CoordinateModel class containing a list of CoordinateLists
+    CoordinateModel class containing a list of CoordinateLists, the coordinates of all CoordinateLists are stored
+    in one concatenated Nx3 array with the offsets of every CoordinateList and the CoordinateLists are views on it
     """
 
     def __init__(self, coordinate_list: cl.CoordinateList = None) -> None:
         self.__coordinate_lists = []
+        self.__coordinates = np.empty((0, 3))
+        self.__offsets = np.zeros(1, dtype=np.int64)
+        self.__is_shared = False
         if isinstance(coordinate_list, cl.CoordinateList):
             self.__coordinate_lists.append(coordinate_list)
 
@@ -24,9 +30,95 @@ class CoordinateModel:
 
     def copy(self) -> 'CoordinateModel':
         """
-        Create a copy of a CoordinateModel object
+        Create a copy of a CoordinateModel object, the copy shares the concatenated array with the CoordinateModel
+        until one of them changes it
         """
-        return copy.deepcopy(self)
+        coordinates, offsets = self.get_arrays()
+
+        coordinate_model = CoordinateModel()
+        for i, coordinate_list in enumerate(self.__coordinate_lists):
+            coordinate_list_copy = cl.CoordinateList()
+            coordinate_list_copy.set_height(coordinate_list.get_height())
+            coordinate_list_copy.bind_array(coordinates[offsets[i]:offsets[i + 1]])
+            coordinate_model.__coordinate_lists.append(coordinate_list_copy)
+        coordinate_model.__coordinates = coordinates
+        coordinate_model.__offsets = offsets
+        coordinate_model.__is_shared = True
+        self.__is_shared = True
+
+        return coordinate_model
+
+    def __is_packed(self) -> bool:
+        """
+        Return True if every CoordinateList is still the view on the concatenated array at its offset
+        """
+        if len(self.__offsets) != len(self.__coordinate_lists) + 1:
+            return False
+
+        address = self.__coordinates.__array_interface__['data'][0]
+        row_size = self.__coordinates.strides[0]
+        for i, coordinate_list in enumerate(self.__coordinate_lists):
+            coordinates = coordinate_list.get_array()
+            if len(coordinates) != self.__offsets[i + 1] - self.__offsets[i]:
+                return False
+            if len(coordinates) > 0 and (coordinates.base is not self.__coordinates or
+                                         coordinates.__array_interface__['data'][0] !=
+                                         address + self.__offsets[i] * row_size):
+                return False
+
+        return True
+
+    def __pack(self) -> None:
+        """
+        Concatenate the coordinates of all CoordinateLists into one array and bind the CoordinateLists to it,
+        nothing is done if they are still bound to the concatenated array
+        """
+        if self.__is_packed():
+            return
+
+        lengths = [coordinate_list.len() for coordinate_list in self.__coordinate_lists]
+        coordinates = np.empty((sum(lengths), 3))
+        self.__offsets = np.concatenate(([0], np.cumsum(lengths, dtype=np.int64)))
+        for i, coordinate_list in enumerate(self.__coordinate_lists):
+            coordinates[self.__offsets[i]:self.__offsets[i + 1]] = coordinate_list.get_array()
+        self.__coordinates = coordinates
+        self.__is_shared = False
+        self.__bind_coordinate_lists()
+
+    def __bind_coordinate_lists(self) -> None:
+        """
+        Bind every CoordinateList to its view on the concatenated array
+        """
+        for i, coordinate_list in enumerate(self.__coordinate_lists):
+            coordinate_list.bind_array(self.__coordinates[self.__offsets[i]:self.__offsets[i + 1]])
+
+    def __get_own_arrays(self) -> (np.array, np.array):
+        """
+        Return the concatenated array and the offsets, the array is copied first if it is shared with a copy
+        """
+        self.__pack()
+        if self.__is_shared:
+            self.__coordinates = self.__coordinates.copy()
+            self.__is_shared = False
+            self.__bind_coordinate_lists()
+
+        return self.__coordinates, self.__offsets
+
+    def get_arrays(self) -> (np.array, np.array):
+        """
+        Return the coordinates of all CoordinateLists as one concatenated Nx3 array and the offsets of the
+        CoordinateLists, the coordinates of CoordinateList i are array[offsets[i]:offsets[i + 1]]
+        """
+        self.__pack()
+
+        return self.__coordinates, self.__offsets
+
+    def get_heights(self) -> np.array:
+        """
+        Return the heights of all CoordinateLists as an array
+        """
+        return np.array([coordinate_list.get_height() for coordinate_list in self.__coordinate_lists],
+                        dtype=np.float64)
 
     def append(self, coordinate_list: cl.CoordinateList) -> None:
         """
@@ -94,47 +186,53 @@ class CoordinateModel:
         """
         Transform all CoordinateLists from lv95 to google earth
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.transform_from_lv95_to_google_earth()
+        coordinates, offsets = self.get_arrays()
+        altitudes = coordinates[:, 2] + np.repeat(self.get_heights(), np.diff(offsets))
+        self.transform_from_lv95_to_etrf93_geographic()
+        # replace the 3rd column of the transformed coordinates by the altitudes
+        self.__coordinates[:, 2] = altitudes
 
     def apply_transformation_matrix(self, t: list) -> None:
         """
         Apply a transformation matrix to all CoordinateLists
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.apply_transformation_matrix(t)
+        coordinates, _ = self.__get_own_arrays()
+        transformations.apply_transformation_to_points(coordinates, t, in_place=True)
 
     def transform_from_lv95_to_etrf93_geographic(self) -> None:
         """ 
         Apply lv95 to etrf93 geographic transformation to all 
         CoordinateLists using swissreframe
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.transform_from_lv95_to_etrf93_geographic()
+        self.__transform_all(reframe.LV95_TO_ETRF93_GEOGRAPHIC)
 
     def transform_from_lv95_to_etrf93_geocentric(self) -> None:
         """
         Apply lv95 to etrf93 geocentric transformation to all
         CoordinateLists using swissreframe
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.transform_from_lv95_to_etrf93_geocentric()
+        self.__transform_all(reframe.LV95_TO_ETRF93_GEOCENTRIC)
 
     def transform_from_etrf93_geographic_to_lv95(self) -> None:
         """
         Apply etrf93 geographic to lv95 transformation to all 
         CoordinateLists using swissreframe
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.transform_from_etrf93_geographic_to_lv95()
+        self.__transform_all(reframe.ETRF93_GEOGRAPHIC_TO_LV95)
 
     def transform_from_etrf93_geocentric_to_lv95(self) -> None:
         """
         Apply etrf93 geocentric to lv95 transformation to all 
         CoordinateLists using swissreframe
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.transform_from_etrf93_geocentric_to_lv95()
+        self.__transform_all(reframe.ETRF93_GEOCENTRIC_TO_LV95)
+
+    def __transform_all(self, transformation: str) -> None:
+        """
+        Transform the coordinates of all CoordinateLists with the swissreframe transformation in one batch
+        """
+        coordinates, _ = self.__get_own_arrays()
+        coordinates[:] = reframe.transform_coordinates(coordinates, transformation)
 
     def print(self) -> None:
         """
@@ -158,30 +256,20 @@ class CoordinateModel:
         """
         Apply a transformation matrix from points for transformation
         """
-        for coordinate_list in self.__coordinate_lists:
-            coordinate_list.apply_transformation_matrix_from_points_for_transformation(
-                path, file_name)
+        self.apply_transformation_matrix(
+            transformations.read_transformation_matrix_from_points_from_xlsx(path, file_name))
 
-    def create_kml_for_google_earth(self, path: str, file_name: str) -> None:
+    def create_kml_for_google_earth(self, path: str,
+                                    file_name: str,
+                                    do_transform_to_google_earth: bool = False,
+                                    num_workers: int = 1) -> None:
         """
-        Create a KML file for google earth from the CoordinateList
+        Create a kml or kmz file for google earth from the CoordinateLists, the polygons are streamed into the
+        file. With do_transform_to_google_earth the lv95 coordinates are transformed on the fly and the
+        CoordinateModel is left unchanged.
         """
         path = helper.create_subdir_if_not_exists(os.path.join(path, "models"), "kml")
 
-        # create a new KML object
-        kml = simplekml.Kml()
-        cntr = 0
-        hex_color_idx = 0
-        for coordinate_list in self.__coordinate_lists:
-            # create a polygon with the defined points and extrude it
-            coordinate_list.create_kml_polygon_from_coordinates(kml,
-                                                                os.path.splitext(file_name)[0] +
-                                                                "_" + str(cntr),
-                                                                hex_color_idx)
-            cntr += cntr
-            hex_color_idx += 1
-            if hex_color_idx == self.len():
-                hex_color_idx = 0
-
-        # save the KML file
-        kml.save(os.path.join(path, file_name))
+        kmlwriter.write_kml(os.path.join(path, file_name), self,
+                            do_transform_to_google_earth=do_transform_to_google_earth,
+                            num_workers=num_workers)
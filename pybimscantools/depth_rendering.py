@@ -3,19 +3,29 @@
 # TODO:
 # - parse_camera_parameters_and_scale currently not used for transformation.
 
+import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import matplotlib.pyplot as plt
 import numpy as np
 import open3d as o3d
-import laspy
 
 from pybimscantools import helper
+from pybimscantools import pointcloud
+from pybimscantools import textcolor
 from pybimscantools import transformations
 
 
 SCALE_PARAMS = 1.0 / 3.5
 SHOW_PLT = False
+DEPTH_SCALE = 1000.0
+DEPTH_OUTPUTS = ('png', 'npy', 'npy_stack')
+DEPTH_STACK_FILE_NAME = 'depth_stack.npy'
+DEPTH_INDEX_FILE_NAME = 'depth_index.json'
+DEPTH_MANIFEST_FILE_NAME = 'depth_manifest.json'
 # VOXEL_SIZE = 0.03 # downsampling, currently not used
 
 
@@ -102,29 +112,246 @@ def transform_to_intrinsic(t: np.array) -> np.array:
     return t_cam @ transformations.get_inverse_transformation_matrix(t)
 
 
+class ImageWriter:
+    """
+    Bounded background writer that takes the encoding and saving of images off the rendering thread
+    """
+
+    def __init__(self, num_threads: int = 4, max_pending: int = 16) -> None:
+        self.__executor = None
+        if num_threads > 0:
+            self.__executor = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="image_writer")
+        self.__pending = threading.BoundedSemaphore(max(max_pending, 1))
+        self.__lock = threading.Lock()
+        self.__errors = []
+
+    def submit(self, description: str, function, *args) -> None:
+        """
+        Queue a write job, blocks as long as max_pending jobs are waiting to be written
+        """
+        if self.__executor is None:
+            self.__run(description, function, *args)
+            return
+
+        self.__pending.acquire()
+        try:
+            self.__executor.submit(self.__run, description, function, *args)
+        except Exception:
+            self.__pending.release()
+            raise
+
+    def __run(self, description: str, function, *args) -> None:
+        """
+        Execute a write job and capture its error instead of losing it in the worker thread
+        """
+        try:
+            function(*args)
+        except Exception as e:
+            with self.__lock:
+                self.__errors.append((description, e))
+        finally:
+            if self.__executor is not None:
+                self.__pending.release()
+
+    def close(self) -> None:
+        """
+        Wait until all queued jobs are written and raise if any of them failed
+        """
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=True)
+
+        if self.__errors:
+            for description, e in self.__errors:
+                print(textcolor.colored_text(f"   writing {description} failed: {e}", "Red"))
+            raise RuntimeError(f"ImageWriter.close(): {len(self.__errors)} image(s) could not be written")
+
+
+def write_image(file_path: str, image: np.array) -> None:
+    """
+    Encode and save an image given as a uint8 (color) or uint16 (depth) array
+    """
+
+    o3d.io.write_image(file_path, o3d.geometry.Image(np.ascontiguousarray(image)))
+
+
+def convert_depth_to_png_scale(depth: np.array, depth_scale: float = DEPTH_SCALE) -> np.array:
+    """
+    Convert a float depth image in meters to the 16 bit representation used for the depth png files
+    """
+
+    return np.clip(depth * depth_scale, 0.0, 65535.0).astype(np.uint16)
+
+
+def write_depth_index(path_sub_dir: str,
+                      depth_output: str,
+                      width: int,
+                      height: int,
+                      intrinsic: tuple,
+                      image_entries: list,
+                      file_name: str = DEPTH_INDEX_FILE_NAME) -> None:
+    """
+    Write the index of the raw depth output containing the image names and the camera parameters
+    """
+
+    fx, fy, cx, cy = intrinsic
+    index = {
+        "depth_output": depth_output,
+        "dtype": "float32",
+        "unit": "m",
+        "width": width,
+        "height": height,
+        "intrinsic": {"fx": fx, "fy": fy, "cx": cx, "cy": cy},
+        "images": image_entries
+    }
+    if depth_output == 'npy_stack':
+        index["stack_file_name"] = DEPTH_STACK_FILE_NAME
+
+    with open(os.path.join(path_sub_dir, file_name), 'w') as f:
+        json.dump(index, f, indent=4)
+
+
+def load_depth_images(path: str, file_name: str = DEPTH_INDEX_FILE_NAME) -> (dict, object):
+    """
+    Load the raw float32 depth output written by render_depth_images and return the index and the depth data.
+    For the npy_stack output the depth data is a read only memory-mapped Nxheightxwidth array, for the npy output
+    it is a list of memory-mapped heightxwidth arrays in the order of the index
+    """
+
+    path_sub_dir = os.path.join(path, "images", "depth_rendered")
+
+    with open(os.path.join(path_sub_dir, file_name), 'r') as f:
+        index = json.load(f)
+
+    if index["depth_output"] == 'npy_stack':
+        depth = np.load(os.path.join(path_sub_dir, index["stack_file_name"]), mmap_mode='r')
+    else:
+        depth = [np.load(os.path.join(path_sub_dir, entry["depth_file_name"]), mmap_mode='r')
+                 for entry in index["images"]]
+
+    return index, depth
+
+
+def read_depth_manifest(path_sub_dir: str, file_name: str = DEPTH_MANIFEST_FILE_NAME) -> dict:
+    """
+    Read the manifest of the already rendered images, an empty manifest is returned if there is none
+    """
+
+    if not helper.does_file_name_exist_in_path(path_sub_dir, file_name):
+        return {"source": {}, "images": {}}
+
+    with open(os.path.join(path_sub_dir, file_name), 'r') as f:
+        return json.load(f)
+
+
+def write_depth_manifest(path_sub_dir: str, manifest: dict, file_name: str = DEPTH_MANIFEST_FILE_NAME) -> None:
+    """
+    Write the manifest of the rendered images
+    """
+
+    with open(os.path.join(path_sub_dir, file_name), 'w') as f:
+        json.dump(manifest, f, indent=4)
+
+
+def get_source_fingerprint(file_path: str, previous_source: dict) -> dict:
+    """
+    Return the fingerprint of the rendered point cloud file, the content hash is only recomputed if the
+    size or the modification time of the file differ from the previous fingerprint
+    """
+
+    stat = os.stat(file_path)
+    source = {"file_name": os.path.basename(file_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if all(previous_source.get(key) == value for key, value in source.items()) and "hash" in previous_source:
+        source["hash"] = previous_source["hash"]
+    else:
+        source["hash"] = helper.get_file_hash(file_path)
+
+    return source
+
+
+def get_render_fingerprint(source_hash: str, extrinsic: np.array, settings: dict) -> str:
+    """
+    Return the fingerprint of a rendered image made of the source point cloud hash,
+    the camera pose and intrinsics and the render settings
+    """
+
+    render_hash = hashlib.sha256()
+    render_hash.update(source_hash.encode('ascii'))
+    render_hash.update(np.ascontiguousarray(extrinsic, dtype=np.float64).tobytes())
+    render_hash.update(json.dumps(settings, sort_keys=True).encode('ascii'))
+
+    return render_hash.hexdigest()
+
+
+def get_output_file_names(img_name: str, depth_output: str) -> list:
+    """
+    Return the names of the files written for one image with the given depth output
+    """
+
+    output_file_names = [img_name + "_pc_image.png"]
+    if depth_output == 'png':
+        output_file_names.append(img_name + "_depth.png")
+    elif depth_output == 'npy':
+        output_file_names.append(img_name + "_depth.npy")
+    else:
+        output_file_names.append(DEPTH_STACK_FILE_NAME)
+
+    return output_file_names
+
+
 def render_depth_images(img_filename_list: list,
                         img_transformation_list: list,
                         path: str,
                         file_name: str='pointcloud.las',
-                        do_use_transformed_pointcloud: bool = False) -> None:
+                        do_use_transformed_pointcloud: bool = False,
+                        depth_output: str = 'png',
+                        num_writer_threads: int = 4,
+                        max_pending_writes: int = 16,
+                        skip_unchanged: bool = True) -> None:
     """"
-    Render depth images for the given images and transformations
+    Render depth images for the given images and transformations, the pointcloud file_name can be a *.las or *.laz file.
+    depth_output selects how the depth is stored: 'png' writes 16 bit png files scaled by DEPTH_SCALE,
+    'npy' writes one float32 *.npy file per image and 'npy_stack' writes all images into one memory-mapped
+    float32 *.npy stack. The raw outputs are accompanied by an index with the image names and camera parameters.
+    Encoding and saving is done by num_writer_threads background threads with at most max_pending_writes images
+    waiting in memory, num_writer_threads = 0 writes on the rendering thread.
+    A manifest with a fingerprint of the point cloud, the camera and the render settings is kept per image,
+    with skip_unchanged only new or changed images are rendered.
     """
 
+    if depth_output not in DEPTH_OUTPUTS:
+        raise ValueError(f"render_depth_images(): depth_output must be one of {DEPTH_OUTPUTS}")
+
     # sub directory for ply files
     path_sub_dir = helper.create_subdir_if_not_exists(path, "polygons")
 
-    # check if ply file exists and if not create it out of the las file
+    if do_use_transformed_pointcloud:
+        file_path = os.path.join(path, "pointclouds", "transformed", file_name)
+    else:
+        file_path = os.path.join(path, "pointclouds", file_name)
+
+    # fingerprint the source point cloud, the ply is only used as source if the point cloud is not available
     file_name_ply = file_name.split(".")[0] + ".ply"
     # file_name_ply = file_name.split(".")[0] + "_subsampled_" + str(VOXEL_SIZE * 100).replace(".", "_") + "_cm.ply"
-    if helper.does_file_name_exist_in_path(path_sub_dir, file_name_ply):
-        pcd = o3d.io.read_point_cloud(os.path.join(path_sub_dir, file_name_ply))
-
+    path_depth_rendered = helper.create_subdir_if_not_exists(os.path.join(path, "images"), "depth_rendered")
+    manifest = read_depth_manifest(path_depth_rendered)
+    is_pointcloud_available = os.path.isfile(file_path)
+    if is_pointcloud_available:
+        source = get_source_fingerprint(file_path, manifest["source"])
     else:
-        if do_use_transformed_pointcloud:
-            las_file = laspy.read(os.path.join(path, "pointclouds", "transformed", file_name))
-        else:
-            las_file = laspy.read(os.path.join(path, "pointclouds", file_name))
+        source = get_source_fingerprint(os.path.join(path_sub_dir, file_name_ply), manifest["source"])
+    is_source_changed = source["hash"] != manifest["source"].get("hash")
+
+    # check if ply file exists and is up to date and if not create it out of the las file
+    pcd = None
+    if not helper.does_file_name_exist_in_path(path_sub_dir, file_name_ply) or \
+            (is_source_changed and is_pointcloud_available):
+        # fail before loading the point cloud if it has no colors
+        pointcloud.check_pointcloud_dimensions(file_path, ('red', 'green', 'blue'))
+        profile = pointcloud.read_pointcloud_profile(file_path)
+        if profile is not None and not profile["has_color"]:
+            print(textcolor.colored_text(f"   all colors of {file_name} are zero", "Orange"))
+
+        las_file = pointcloud.read_pointcloud(file_path)
 
         # convert the data to Open3D format
         pcd = o3d.geometry.PointCloud()
@@ -137,52 +364,159 @@ def render_depth_images(img_filename_list: list,
         # save the point cloud
         o3d.io.write_point_cloud(os.path.join(path, "polygons", file_name_ply), pcd)
 
-
-    # create window
-    vis = o3d.visualization.Visualizer()
-    visible = False
     width, height = extract_width_and_height_and_scale(path, SCALE_PARAMS)
-    vis.create_window(width=width, height=height, visible=visible)
-
-    # add point cloud
-    vis.add_geometry(pcd)
 
     # sub directory for depth rendered images
-    path_sub_dir = helper.create_subdir_if_not_exists(os.path.join(path, "images"), "depth_rendered")
-
-    # create pin hole camera parameters
-    pin_hole_camera_parameters = o3d.camera.PinholeCameraParameters()
+    path_sub_dir = path_depth_rendered
 
     # read camera and set intrinsic and extrinsic parameters
     # - currently all the images use the same intrinsic parameters, so i choose the first one
     # - the transformation extracted here is the original one from PIX4D and not necessary the IFC
     fx, fy, cx, cy, t = parse_camera_parameters_and_scale(path, img_filename_list[0], SCALE_PARAMS)
-    pin_hole_camera_parameters.intrinsic = o3d.camera.PinholeCameraIntrinsic(width, height, fx, fy, cx, cy)
 
-    for image_nr in range(len(img_filename_list)):
-
-        pin_hole_camera_parameters.extrinsic = transform_to_intrinsic(img_transformation_list[image_nr])
-
-        # set intrinsic and extrinsic parameters
-        vis.get_view_control().convert_from_pinhole_camera_parameters(pin_hole_camera_parameters, allow_arbitrary=True)
-        vis.update_renderer()
-
-        # capture depth
-        depth = vis.capture_depth_float_buffer(do_render=True)
-        if SHOW_PLT:
-            plt.imshow(depth)
-            plt.show()
-        vis.capture_depth_image(os.path.join(path_sub_dir, img_filename_list[image_nr].split(".")[0] + "_depth.png"), do_render=True, depth_scale=1000.0)
-
-        # capture image
-        image = vis.capture_screen_float_buffer(do_render=True)
-        if SHOW_PLT:
-            plt.imshow(image)
-            plt.show()
-        vis.capture_screen_image(os.path.join(path_sub_dir, img_filename_list[image_nr].split(".")[0] + "_pc_image.png"), do_render=True)
-
-        print(f"   {img_filename_list[image_nr]} pc image and depth saved")
+    # the rendered images are kept as long as the content of the point cloud is the same, a touched or copied
+    # point cloud only updates the fingerprint
+    if is_source_changed:
+        manifest = {"source": source, "images": {}}
+    else:
+        manifest["source"] = source
+    settings = {"width": width, "height": height, "intrinsic": [fx, fy, cx, cy],
+                "depth_output": depth_output, "depth_scale": DEPTH_SCALE}
 
-        # #  TODO: remove me
-        # if image_nr == 5:
-        #     break
\ No newline at end of file
+    image_entries = []
+    fingerprints = []
+    images_to_render = []
+    for image_nr in range(len(img_filename_list)):
+        img_name = img_filename_list[image_nr].split(".")[0]
+        extrinsic = transform_to_intrinsic(img_transformation_list[image_nr])
+
+        image_entry = {"image_name": img_filename_list[image_nr],
+                       "transformation": np.asarray(img_transformation_list[image_nr]).tolist(),
+                       "extrinsic": extrinsic.tolist()}
+        if depth_output == 'npy':
+            image_entry["depth_file_name"] = img_name + "_depth.npy"
+        elif depth_output == 'npy_stack':
+            image_entry["stack_index"] = image_nr
+        image_entries.append(image_entry)
+
+        fingerprints.append(get_render_fingerprint(source["hash"], extrinsic, settings))
+        previous = manifest["images"].get(img_filename_list[image_nr], {})
+        is_unchanged = (skip_unchanged and previous.get("fingerprint") == fingerprints[-1] and
+                        (depth_output != 'npy_stack' or previous.get("stack_index") is not None) and
+                        all(helper.does_file_name_exist_in_path(path_sub_dir, output_file_name)
+                            for output_file_name in get_output_file_names(img_name, depth_output)))
+        if not is_unchanged:
+            images_to_render.append(image_nr)
+
+    # the raw depth of all images is written into one memory-mapped stack, an existing stack is updated in place
+    # if it holds the unchanged images at the same positions, otherwise the unchanged images are copied over,
+    # also if nothing is rendered but images were removed or moved
+    depth_stack = None
+    file_path_stack = os.path.join(path_sub_dir, DEPTH_STACK_FILE_NAME)
+    file_path_stack_new = None
+    if depth_output == 'npy_stack':
+        stack_shape = (len(img_filename_list), height, width)
+        images_to_keep = sorted(set(range(len(img_filename_list))) - set(images_to_render))
+        previous_stack_index = [manifest["images"][img_filename_list[image_nr]]["stack_index"]
+                                for image_nr in images_to_keep]
+        if images_to_keep:
+            previous_stack = np.load(file_path_stack, mmap_mode='r')
+            if previous_stack.shape == stack_shape and previous_stack_index == images_to_keep:
+                del previous_stack
+                if images_to_render:
+                    depth_stack = np.load(file_path_stack, mmap_mode='r+')
+            else:
+                file_path_stack_new = file_path_stack + ".new"
+                depth_stack = np.lib.format.open_memmap(file_path_stack_new, mode='w+',
+                                                        dtype=np.float32, shape=stack_shape)
+                for image_nr, stack_index in zip(images_to_keep, previous_stack_index):
+                    depth_stack[image_nr] = previous_stack[stack_index]
+                del previous_stack
+        elif images_to_render:
+            depth_stack = np.lib.format.open_memmap(file_path_stack, mode='w+', dtype=np.float32, shape=stack_shape)
+
+    # report the skipped images
+    images_to_skip = sorted(set(range(len(img_filename_list))) - set(images_to_render))
+    for image_nr in images_to_skip:
+        print(f"   {img_filename_list[image_nr]} unchanged, skipped")
+    if images_to_skip:
+        print(textcolor.colored_text(f"   {len(images_to_skip)} of {len(img_filename_list)} images unchanged and "
+                                     f"skipped, {len(images_to_render)} images to render", "Green"))
+
+    if images_to_render:
+        # load the point cloud only if there is something to render
+        if pcd is None:
+            pcd = o3d.io.read_point_cloud(os.path.join(path, "polygons", file_name_ply))
+
+        # create window
+        vis = o3d.visualization.Visualizer()
+        visible = False
+        vis.create_window(width=width, height=height, visible=visible)
+
+        # add point cloud
+        vis.add_geometry(pcd)
+
+        # create pin hole camera parameters
+        pin_hole_camera_parameters = o3d.camera.PinholeCameraParameters()
+        pin_hole_camera_parameters.intrinsic = o3d.camera.PinholeCameraIntrinsic(width, height, fx, fy, cx, cy)
+
+        # background writer for the png and npy files
+        image_writer = ImageWriter(num_writer_threads, max_pending_writes)
+
+        for image_nr in images_to_render:
+
+            pin_hole_camera_parameters.extrinsic = np.array(image_entries[image_nr]["extrinsic"])
+
+            # set intrinsic and extrinsic parameters
+            vis.get_view_control().convert_from_pinhole_camera_parameters(pin_hole_camera_parameters, allow_arbitrary=True)
+            vis.update_renderer()
+
+            # capture depth once and store it in the requested format
+            img_name = img_filename_list[image_nr].split(".")[0]
+            depth = np.asarray(vis.capture_depth_float_buffer(do_render=True), dtype=np.float32)
+            if SHOW_PLT:
+                plt.imshow(depth)
+                plt.show()
+            if depth_output == 'png':
+                image_writer.submit(img_name + "_depth.png", write_image,
+                                    os.path.join(path_sub_dir, img_name + "_depth.png"),
+                                    convert_depth_to_png_scale(depth))
+            elif depth_output == 'npy':
+                image_writer.submit(image_entries[image_nr]["depth_file_name"], np.save,
+                                    os.path.join(path_sub_dir, image_entries[image_nr]["depth_file_name"]), depth)
+            else:
+                depth_stack[image_nr] = depth
+
+            # capture image
+            image = np.asarray(vis.capture_screen_float_buffer(do_render=True))
+            if SHOW_PLT:
+                plt.imshow(image)
+                plt.show()
+            image_writer.submit(img_name + "_pc_image.png", write_image,
+                                os.path.join(path_sub_dir, img_name + "_pc_image.png"),
+                                (np.clip(image, 0.0, 1.0) * 255.0).round().astype(np.uint8))
+
+            print(f"   {img_filename_list[image_nr]} pc image and depth rendered")
+
+        vis.destroy_window()
+
+        # wait for the pending writes, write errors are raised here and leave the manifest untouched
+        image_writer.close()
+
+    if depth_stack is not None:
+        depth_stack.flush()
+        del depth_stack
+        if file_path_stack_new is not None:
+            os.replace(file_path_stack_new, file_path_stack)
+
+    if depth_output != 'png':
+        write_depth_index(path_sub_dir, depth_output, width, height, (fx, fy, cx, cy), image_entries)
+
+    # record what was rendered from which inputs, only the current images are part of the stack
+    if depth_output == 'npy_stack':
+        for entry in manifest["images"].values():
+            entry["stack_index"] = None
+    for image_nr in range(len(img_filename_list)):
+        manifest["images"][img_filename_list[image_nr]] = {"fingerprint": fingerprints[image_nr],
+                                                           "stack_index": image_entries[image_nr].get("stack_index")}
+    write_depth_manifest(path_sub_dir, manifest)
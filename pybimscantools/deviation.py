@@ -0,0 +1,294 @@
+""" This file contains the scan-to-BIM deviation engine that measures the signed distance
+of a pointcloud in the IFC coordinate system to the tessellated IFC elements
+"""
+
+import multiprocessing
+import os
+
+import ifcopenshell
+import ifcopenshell.geom
+import laspy
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+from scipy.spatial import cKDTree
+
+from pybimscantools import helper
+from pybimscantools import pointcloud
+from pybimscantools import textcolor
+
+
+# point formats without color and their counterpart with color
+RGB_POINT_FORMATS = {0: 2, 1: 3, 2: 2, 3: 3, 4: 5, 5: 5, 6: 7, 7: 7, 8: 8, 9: 10, 10: 10}
+
+# number of nearest samples whose triangle planes are tested per point
+NR_CANDIDATE_SAMPLES = 8
+
+
+class DeviationEngine:
+    """
+    DeviationEngine class that tessellates the IFC elements once, samples the triangles and
+    computes per point signed distances of pointclouds to the nearest element
+    """
+
+    def __init__(self, ifc_file: str,
+                 sample_spacing: float = 0.05,
+                 ifc_types: list = None,
+                 num_threads: int = None) -> None:
+        self.sample_spacing = sample_spacing
+        self.num_threads = num_threads if num_threads is not None else multiprocessing.cpu_count()
+        self.element_guids = []
+        self.element_types = []
+        self.element_names = []
+        self.samples = None
+        self.sample_normals = None
+        self.sample_elements = None
+        self.tree = None
+
+        vertices, faces, face_elements = self.tessellate(ifc_file, ifc_types)
+        self.sample_triangles(vertices, faces, face_elements)
+        self.tree = cKDTree(self.samples)
+
+        print(f"   {len(self.element_guids)} elements tessellated into {len(faces)} triangles "
+              f"and {len(self.samples)} samples")
+
+    def tessellate(self, ifc_file: str, ifc_types: list = None) -> (np.array, np.array, np.array):
+        """
+        Tessellate the IFC elements in world coordinates and return the stacked vertices,
+        the triangle faces and the element index of every face
+        """
+        model = ifcopenshell.open(ifc_file)
+
+        settings = ifcopenshell.geom.settings()
+        settings.set(settings.USE_WORLD_COORDS, True)
+
+        include = None
+        if ifc_types is not None:
+            include = [element for ifc_type in ifc_types for element in model.by_type(ifc_type)]
+            if len(include) == 0:
+                raise ValueError(f"DeviationEngine.tessellate(): no elements of the types {ifc_types} were found")
+
+        if include is None:
+            iterator = ifcopenshell.geom.iterator(settings, model, self.num_threads)
+        else:
+            iterator = ifcopenshell.geom.iterator(settings, model, self.num_threads, include=include)
+
+        vertices = []
+        faces = []
+        face_elements = []
+        nr_vertices = 0
+        if iterator.initialize():
+            while True:
+                shape = iterator.get()
+                shape_vertices = np.array(shape.geometry.verts, dtype=np.float64).reshape(-1, 3)
+                shape_faces = np.array(shape.geometry.faces, dtype=np.int64).reshape(-1, 3)
+                if len(shape_faces) > 0:
+                    element = model.by_id(shape.id)
+                    vertices.append(shape_vertices)
+                    faces.append(shape_faces + nr_vertices)
+                    face_elements.append(np.full(len(shape_faces), len(self.element_guids), dtype=np.int64))
+                    nr_vertices += len(shape_vertices)
+                    self.element_guids.append(shape.guid)
+                    self.element_types.append(element.is_a())
+                    self.element_names.append(str(getattr(element, "Name", None)))
+                if not iterator.next():
+                    break
+
+        if len(faces) == 0:
+            raise ValueError(f"DeviationEngine.tessellate(): no geometry could be created from {ifc_file}")
+
+        return np.vstack(vertices), np.vstack(faces), np.concatenate(face_elements)
+
+    def sample_triangles(self, vertices: np.array, faces: np.array, face_elements: np.array) -> None:
+        """
+        Sample the triangles with about one sample per sample_spacing^2 plus the corners,
+        every sample keeps the normal of its triangle and the index of its element
+        """
+        a = vertices[faces[:, 0]]
+        b = vertices[faces[:, 1]]
+        c = vertices[faces[:, 2]]
+        normals = np.cross(b - a, c - a)
+        double_areas = np.linalg.norm(normals, axis=1)
+        is_valid = double_areas > 0
+        a, b, c = a[is_valid], b[is_valid], c[is_valid]
+        normals = normals[is_valid] / double_areas[is_valid, None]
+        face_elements = face_elements[is_valid]
+
+        # number of interior samples per triangle proportional to its area, at least the centroid
+        nr_samples = np.maximum(np.ceil(0.5 * double_areas[is_valid] / self.sample_spacing ** 2), 1).astype(np.int64)
+        triangle_nr = np.repeat(np.arange(len(a)), nr_samples)
+
+        # uniform barycentric coordinates, the first sample of every triangle is its centroid
+        rng = np.random.default_rng(0)
+        u = rng.random(len(triangle_nr))
+        v = rng.random(len(triangle_nr))
+        is_outside = u + v > 1.0
+        u[is_outside] = 1.0 - u[is_outside]
+        v[is_outside] = 1.0 - v[is_outside]
+        first_sample = np.concatenate(([0], np.cumsum(nr_samples)[:-1]))
+        u[first_sample] = 1.0 / 3.0
+        v[first_sample] = 1.0 / 3.0
+
+        interior = (a[triangle_nr] + u[:, None] * (b[triangle_nr] - a[triangle_nr]) +
+                    v[:, None] * (c[triangle_nr] - a[triangle_nr]))
+
+        self.samples = np.vstack((interior, a, b, c))
+        self.sample_normals = np.vstack((normals[triangle_nr], normals, normals, normals))
+        self.sample_elements = np.concatenate((face_elements[triangle_nr], face_elements, face_elements, face_elements))
+
+    def compute_signed_distances(self, xyz: np.array, max_distance: float = 1.0) -> (np.array, np.array):
+        """
+        Return the signed distance of the points to the nearest element and the element index,
+        points further away than max_distance get a distance of nan and the element index -1
+        """
+        distances, sample_nr = self.tree.query(xyz, k=NR_CANDIDATE_SAMPLES, distance_upper_bound=max_distance,
+                                               workers=self.num_threads)
+
+        signed_distances = np.full(len(xyz), np.nan)
+        elements = np.full(len(xyz), -1, dtype=np.int64)
+        is_matched = np.isfinite(distances[:, 0])
+        if not np.any(is_matched):
+            return signed_distances, elements
+
+        distances = distances[is_matched]
+        sample_nr = sample_nr[is_matched]
+        is_candidate = np.isfinite(distances)
+        sample_nr[~is_candidate] = 0
+        offsets = xyz[is_matched, None, :] - self.samples[sample_nr]
+        plane_distances = np.einsum('ijk,ijk->ij', offsets, self.sample_normals[sample_nr])
+
+        # the distance to the triangle plane is used if the point projects within two sample spacings
+        # of the sample, which the random samples cover almost surely, otherwise the distance to the sample
+        # with the sign of the side of the plane, the candidate sample with the smallest absolute distance wins
+        lateral_distances = np.sqrt(np.maximum(distances ** 2 - plane_distances ** 2, 0.0))
+        candidate_distances = np.where(lateral_distances <= 2.0 * self.sample_spacing,
+                                       plane_distances,
+                                       np.copysign(distances, plane_distances))
+        candidate_distances[~is_candidate] = np.inf
+        best = np.argmin(np.abs(candidate_distances), axis=1)
+        rows = np.arange(len(best))
+        signed_distances[is_matched] = candidate_distances[rows, best]
+        elements[is_matched] = self.sample_elements[sample_nr[rows, best]]
+
+        return signed_distances, elements
+
+    def compute_deviation(self, path: str,
+                          file_name: str,
+                          max_distance: float = 1.0,
+                          color_range: float = 0.1,
+                          chunk_size: int = 1_000_000,
+                          do_use_transformed_pointcloud: bool = True) -> pd.DataFrame:
+        """
+        Compute the signed distance of every point of the pointcloud file_name to the nearest element chunk by chunk.
+        A colorized *.las with an extra dimension deviation and a *.csv with the deviation statistics per element are
+        written to the subdirectory pointclouds/deviation, distances within +-color_range are colored blue to red.
+        """
+        path_pointcloud = os.path.join(path, "pointclouds")
+        path_sub_dir = helper.create_subdir_if_not_exists(path_pointcloud, "deviation")
+        if do_use_transformed_pointcloud:
+            path_pointcloud = os.path.join(path_pointcloud, "transformed")
+
+        if not helper.does_file_name_exist_in_path(path_pointcloud, file_name):
+            print(f"   no {file_name} file was found")
+            return None
+
+        nr_elements = len(self.element_guids)
+        count = np.zeros(nr_elements)
+        sum_distance = np.zeros(nr_elements)
+        sum_squared_distance = np.zeros(nr_elements)
+        sum_absolute_distance = np.zeros(nr_elements)
+        min_distance = np.full(nr_elements, np.inf)
+        max_distance_element = np.full(nr_elements, -np.inf)
+        nr_points = 0
+        nr_unmatched = 0
+
+        colormap = plt.get_cmap('jet')
+        file_name_deviation = os.path.splitext(file_name)[0] + "_deviation.las"
+
+        with pointcloud.open_pointcloud(os.path.join(path_pointcloud, file_name)) as reader:
+            header = create_header_with_deviation(reader.header)
+
+            with laspy.open(os.path.join(path_sub_dir, file_name_deviation), mode='w', header=header) as writer:
+                for points in reader.chunk_iterator(chunk_size):
+                    xyz = np.column_stack((points.x, points.y, points.z))
+                    signed_distances, elements = self.compute_signed_distances(xyz, max_distance)
+
+                    # accumulate the statistics per element
+                    is_matched = elements >= 0
+                    matched_elements = elements[is_matched]
+                    matched_distances = signed_distances[is_matched]
+                    count += np.bincount(matched_elements, minlength=nr_elements)
+                    sum_distance += np.bincount(matched_elements, matched_distances, minlength=nr_elements)
+                    sum_squared_distance += np.bincount(matched_elements, matched_distances ** 2,
+                                                        minlength=nr_elements)
+                    sum_absolute_distance += np.bincount(matched_elements, np.abs(matched_distances),
+                                                         minlength=nr_elements)
+                    np.minimum.at(min_distance, matched_elements, matched_distances)
+                    np.maximum.at(max_distance_element, matched_elements, matched_distances)
+                    nr_points += len(points)
+                    nr_unmatched += int(np.sum(~is_matched))
+
+                    # copy the points and color them by their deviation
+                    points_deviation = laspy.ScaleAwarePointRecord.zeros(len(points), header=header)
+                    for dimension_name in points.point_format.dimension_names:
+                        if dimension_name in header.point_format.dimension_names:
+                            points_deviation[dimension_name] = points[dimension_name]
+                    colors = colormap(np.clip(0.5 + 0.5 * np.nan_to_num(signed_distances) / color_range, 0.0, 1.0))
+                    colors = (colors[:, 0:3] * 65535.0).astype(np.uint16)
+                    colors[~is_matched] = 32767
+                    points_deviation.red = colors[:, 0]
+                    points_deviation.green = colors[:, 1]
+                    points_deviation.blue = colors[:, 2]
+                    points_deviation.deviation = signed_distances.astype(np.float32)
+
+                    writer.write_points(points_deviation)
+                    print(f"   {nr_points} points processed")
+
+                if header.evlrs:
+                    writer.write_evlrs(header.evlrs)
+
+        # deviation statistics per element
+        is_measured = count > 0
+        mean = np.divide(sum_distance, count, out=np.full(nr_elements, np.nan), where=is_measured)
+        rms = np.sqrt(np.divide(sum_squared_distance, count, out=np.full(nr_elements, np.nan), where=is_measured))
+        statistics = pd.DataFrame({'guid': self.element_guids,
+                                   'ifc_type': self.element_types,
+                                   'name': self.element_names,
+                                   'point_count': count.astype(np.int64),
+                                   'mean': mean,
+                                   'std': np.sqrt(np.maximum(rms ** 2 - mean ** 2, 0.0)),
+                                   'rms': rms,
+                                   'mean_absolute': np.divide(sum_absolute_distance, count,
+                                                              out=np.full(nr_elements, np.nan), where=is_measured),
+                                   'min': np.where(is_measured, min_distance, np.nan),
+                                   'max': np.where(is_measured, max_distance_element, np.nan)})
+        statistics = statistics[is_measured].sort_values(by=['rms'], ascending=False)
+        statistics.to_csv(os.path.join(path_sub_dir, os.path.splitext(file_name)[0] + "_deviation.csv"), index=False)
+
+        print(textcolor.colored_text(f"   {nr_points - nr_unmatched} of {nr_points} points within {max_distance} m "
+                                     f"of {int(np.sum(is_measured))} elements, saved {file_name_deviation}", "Green"))
+
+        return statistics
+
+
+def create_header_with_deviation(header: laspy.LasHeader) -> laspy.LasHeader:
+    """
+    Returns a header with the scales, offsets and (e)vlrs of the given header, e.g. the georeferencing,
+    a point format with color and an extra dimension deviation
+    """
+
+    point_format_id = RGB_POINT_FORMATS[header.point_format.id]
+    version = header.version if point_format_id < 6 else "1.4"
+    header_deviation = laspy.LasHeader(point_format=point_format_id, version=version)
+    header_deviation.scales = header.scales
+    header_deviation.offsets = header.offsets
+    header_deviation.global_encoding.wkt = header.global_encoding.wkt
+    # the extra bytes vlr of the source is replaced by the one of the deviation
+    header_deviation.vlrs.extend(vlr for vlr in header.vlrs if not isinstance(vlr, laspy.vlrs.known.ExtraBytesVlr))
+    if header.evlrs is not None:
+        header_deviation.evlrs = laspy.vlrs.vlrlist.VLRList(vlr for vlr in header.evlrs
+                                                            if not isinstance(vlr, laspy.vlrs.known.ExtraBytesVlr))
+    header_deviation.add_extra_dim(laspy.ExtraBytesParams(name="deviation", type=np.float32,
+                                                          description="signed distance to IFC"))
+
+    return header_deviation
@@ -89,16 +89,7 @@ class DroneHarmony:
         def return_geo_json(coordinates: cl.CoordinateList) -> list:
             """ This function returns a geo_json """
             self.list = coordinates
-            num_coordinate = self.list.len()
-            geo_json = []
-            for i in range(0, num_coordinate):
-                geo_json.append(
-                    [
-                        self.list.get_coordinate(i)[0],
-                        self.list.get_coordinate(i)[1],
-                    ]
-                )
-            return geo_json
+            return self.list.get_array()[:, 0:2].tolist()
 
         color_model = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11]
         colors = {
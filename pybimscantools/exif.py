@@ -1,17 +1,15 @@
 import os
-import re
 
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 import piexif
 import piexif.helper
-from PIL import Image
-from pyquaternion import Quaternion
 from scipy.spatial.transform import Rotation
 
 from pybimscantools import helper
 from pybimscantools import textcolor
+from pybimscantools import transformations
 
 
 def plot_camera_frames(img_transformation_list: list) -> None:
@@ -64,7 +62,216 @@ def plot_camera_frames(img_transformation_list: list) -> None:
     plt.show()
 
 
-def extract_file_names_and_transformation_as_lists(path: str) -> (list, list):
+# jpeg markers
+JPEG_SOI = b'\xff\xd8'
+JPEG_APP0 = 0xE0
+JPEG_APP1 = 0xE1
+JPEG_APP15 = 0xEF
+JPEG_SOS = 0xDA
+JPEG_EOI = 0xD9
+EXIF_HEADER = b'Exif\x00\x00'
+XMP_HEADERS = (b'http://ns.adobe.com/xap/1.0/\x00', b'http://ns.adobe.com/xmp/extension/\x00')
+GPS_KEYWORDS = (b'gps', b'latitude', b'longitude')
+NR_POSE_VALUES = 7
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+POSE_SIDECAR_FILE_NAME = 'poses.npz'
+
+
+class PoseTable:
+    """
+    PoseTable class containing the file names, positions and quaternions [w, x, y, z] of images as arrays
+    """
+
+    def __init__(self, file_names: list = None, positions: np.array = None, quaternions: np.array = None) -> None:
+        self.file_names = list(file_names) if file_names is not None else []
+        self.positions = np.empty((0, 3)) if positions is None else np.asarray(positions, dtype=np.float64)
+        self.quaternions = np.empty((0, 4)) if quaternions is None else np.asarray(quaternions, dtype=np.float64)
+        if len(self.file_names) != len(self.positions) or len(self.file_names) != len(self.quaternions):
+            raise ValueError("PoseTable(): file_names, positions and quaternions must have the same length")
+        self.__index = {file_name: i for i, file_name in enumerate(self.file_names)}
+
+    def __len__(self) -> int:
+        """
+        Return the number of poses in the table
+        """
+        return len(self.file_names)
+
+    def get_index(self, file_name: str) -> int:
+        """
+        Return the row of the image file_name
+        """
+        return self.__index[file_name]
+
+    def get_transformations(self) -> np.array:
+        """
+        Return the poses as a Nx4x4 array of transformation matrices
+        """
+        return convert_poses_to_transformations(self.positions, self.quaternions)
+
+
+def get_file_fingerprints(path: str, file_names: list) -> (np.array, np.array):
+    """
+    Returns the sizes and modification times in ns of the files in the given folder
+    """
+
+    stats = [os.stat(os.path.join(path, file_name)) for file_name in file_names]
+
+    return (np.array([stat.st_size for stat in stats], dtype=np.int64),
+            np.array([stat.st_mtime_ns for stat in stats], dtype=np.int64))
+
+
+def write_pose_sidecar(path: str, pose_table: PoseTable, file_name: str = POSE_SIDECAR_FILE_NAME) -> None:
+    """
+    Writes the poses of the images in the given folder as a sidecar *.npz with the image names, positions,
+    quaternions and the size and modification time of every image
+    """
+
+    sizes, mtimes_ns = get_file_fingerprints(path, pose_table.file_names)
+    np.savez(os.path.join(path, file_name),
+             file_names=np.array(pose_table.file_names, dtype=str),
+             positions=pose_table.positions.reshape(-1, 3),
+             quaternions=pose_table.quaternions.reshape(-1, 4),
+             sizes=sizes,
+             mtimes_ns=mtimes_ns)
+
+
+def read_pose_sidecar(path: str, file_name: str = POSE_SIDECAR_FILE_NAME) -> PoseTable:
+    """
+    Reads the sidecar of the images in the given folder and returns a PoseTable with the images that did not
+    change since the sidecar was written, None if there is no sidecar
+    """
+
+    if not os.path.isfile(os.path.join(path, file_name)):
+        return None
+
+    with np.load(os.path.join(path, file_name)) as sidecar:
+        file_names = sidecar["file_names"].tolist()
+        is_unchanged = np.zeros(len(file_names), dtype=bool)
+        for i, img_name in enumerate(file_names):
+            if os.path.isfile(os.path.join(path, img_name)):
+                stat = os.stat(os.path.join(path, img_name))
+                is_unchanged[i] = stat.st_size == sidecar["sizes"][i] and stat.st_mtime_ns == sidecar["mtimes_ns"][i]
+
+        return PoseTable([img_name for i, img_name in enumerate(file_names) if is_unchanged[i]],
+                         sidecar["positions"][is_unchanged],
+                         sidecar["quaternions"][is_unchanged])
+
+
+def get_image_file_names(path: str) -> list:
+    """
+    Returns the sorted names of the jpeg images in the given folder
+    """
+
+    return [file_name for file_name in sorted(os.listdir(path)) if file_name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def read_exif_segment(file_path: str) -> bytes:
+    """
+    Returns the exif APP1 segment of a jpeg file including the Exif header or None if there is none,
+    only the segment headers and the APP1 segment are read and the image data is never touched
+    """
+
+    with open(file_path, 'rb') as f:
+        if f.read(2) != JPEG_SOI:
+            return None
+
+        while True:
+            segment_header = f.read(4)
+            if len(segment_header) < 4 or segment_header[0] != 0xFF:
+                return None
+
+            marker = segment_header[1]
+            length = int.from_bytes(segment_header[2:4], 'big')
+            if marker in (JPEG_SOS, JPEG_EOI) or length < 2:
+                return None
+
+            if marker == JPEG_APP1:
+                segment = f.read(length - 2)
+                if segment.startswith(EXIF_HEADER):
+                    return segment
+            else:
+                f.seek(length - 2, os.SEEK_CUR)
+
+
+def parse_pose(user_comment: bytes) -> np.array:
+    """
+    Parses the pose [x, y, z, qw, qx, qy, qz] written by embed_pose_information from an exif UserComment,
+    raises a ValueError if the comment is not a list of exactly 7 numbers
+    """
+
+    text = piexif.helper.UserComment.load(user_comment).strip()
+    if not (text.startswith('[') and text.endswith(']')):
+        raise ValueError(f"parse_pose(): {text!r} is not a pose")
+
+    values = []
+    for value in text[1:-1].split(','):
+        value = value.strip()
+        # numpy >= 2 writes the numbers as np.float64(...)
+        if value.startswith('np.float64(') and value.endswith(')'):
+            value = value[len('np.float64('):-1]
+        values.append(float(value))
+
+    if len(values) != NR_POSE_VALUES:
+        raise ValueError(f"parse_pose(): expected {NR_POSE_VALUES} values but got {len(values)}")
+
+    return np.array(values)
+
+
+def read_pose(file_path: str) -> np.array:
+    """
+    Reads the pose [x, y, z, qw, qx, qy, qz] embedded in the UserComment of a jpeg file from its exif segment
+    """
+
+    segment = read_exif_segment(file_path)
+    if segment is None:
+        raise ValueError("no exif segment")
+
+    exif_dict = piexif.load(segment)
+    if piexif.ExifIFD.UserComment not in exif_dict["Exif"]:
+        raise ValueError("no UserComment")
+
+    return parse_pose(exif_dict["Exif"][piexif.ExifIFD.UserComment])
+
+
+def read_pose_table(path: str, num_workers: int = 8) -> PoseTable:
+    """
+    Reads the poses of the images in the given folder into a PoseTable. The poses are loaded from the sidecar
+    and only the images that are new or changed since the sidecar was written are read from their exif with
+    num_workers threads, the sidecar is updated afterwards. Images without a valid pose are reported and left out.
+    """
+
+    file_names = get_image_file_names(path)
+
+    sidecar_table = read_pose_sidecar(path)
+    if sidecar_table is None:
+        sidecar_table = PoseTable()
+    file_names_sidecar = set(sidecar_table.file_names)
+    file_names_to_read = [file_name for file_name in file_names if file_name not in file_names_sidecar]
+
+    results = {}
+    if len(file_names_to_read) > 0:
+        results, _ = helper.process_files(read_pose, file_names_to_read,
+                                          [(os.path.join(path, file_name),) for file_name in file_names_to_read],
+                                          num_workers, description="with pose extracted")
+
+    file_names = [file_name for file_name in file_names if file_name in file_names_sidecar or file_name in results]
+    poses = np.empty((len(file_names), NR_POSE_VALUES))
+    for i, file_name in enumerate(file_names):
+        if file_name in results:
+            poses[i] = results[file_name]
+        else:
+            j = sidecar_table.get_index(file_name)
+            poses[i, 0:3] = sidecar_table.positions[j]
+            poses[i, 3:7] = sidecar_table.quaternions[j]
+
+    pose_table = PoseTable(file_names, poses[:, 0:3], poses[:, 3:7])
+    if len(results) > 0:
+        write_pose_sidecar(path, pose_table)
+
+    return pose_table
+
+
+def extract_file_names_and_transformation_as_lists(path: str, num_workers: int = 8) -> (list, list):
     """
     Extracts the pose information from the images in the given folder and returns the file names and the trans as lists
     """
@@ -72,158 +279,212 @@ def extract_file_names_and_transformation_as_lists(path: str) -> (list, list):
     path = os.path.join(path, "images")
     path = os.path.join(path, "pose_embedded")
 
-    img_filename_list = []
-    img_transformation_list = []
+    pose_table = read_pose_table(path, num_workers)
 
-    file_cntr = 0
-    for file_name in os.listdir(path):
-        try:
-            img = Image.open(os.path.join(path, file_name))
-            exif_dict = piexif.load(img.info['exif'])
+    if len(pose_table) == 0:
+        print(textcolor.colored_text("   no images found in the folder!", "Red"))
 
-            # decode the bytes to string
-            decoded_string = exif_dict["Exif"][piexif.ExifIFD.UserComment].decode('ascii')
+    return pose_table.file_names, list(pose_table.get_transformations())
 
-            # extract the numerical data from brackets
-            match = re.search(r'\[(.*?)\]', decoded_string)
-            if match:
-                numbers = match.group(1)
-            else:
-                numbers = ""
 
-            # convert string numbers to a list of floats
-            cleaned_numbers = re.sub(r'np\.float64\((.*?)\)', r'\1', numbers)
-            float_nums = list(map(float, cleaned_numbers.split(',')))
+def write_exif(file_path: str, file_path_output: str, exif_dict: dict) -> None:
+    """
+    Writes the jpeg image with the exif directory replaced by exif_dict to file_path_output, only the exif segment
+    is rewritten and the compressed image data is copied without re-encoding
+    """
 
-            # extraxt transformation matrix
-            t = np.identity(4)
-            t[0:3, 0:3] = Quaternion(float_nums[3:]).rotation_matrix
-            t[0:3, 3] = np.array(float_nums[:3])
-            t[3, 3] = 1.0
+    exif_bytes = piexif.dump(exif_dict)
+    if os.path.abspath(file_path) == os.path.abspath(file_path_output):
+        piexif.insert(exif_bytes, file_path)
+    else:
+        piexif.insert(exif_bytes, file_path, file_path_output)
 
-            # inform user
-            file_cntr += 1
-            print(f"   {file_name} extracted pose")
 
-            # extract pos and quat for each image
-            img_filename_list.append(file_name)
-            img_transformation_list.append(t)
-        except:
-            pass
+def is_location_segment(marker: int, segment: bytes) -> bool:
+    """
+    Returns True if the APPn segment may carry the location, these are the xmp segments (e.g. the
+    drone-dji:GpsLatitude of DJI images) and every other APPn segment that mentions GPS, latitude or longitude
+    """
 
-        # #  TODO: remove me
-        # if file_cntr == 5:
-        #     break
+    if not JPEG_APP0 <= marker <= JPEG_APP15 or segment.startswith(EXIF_HEADER):
+        return False
+    if segment.startswith(XMP_HEADERS):
+        return True
 
-    if file_cntr == 0:
-        print(textcolor.colored_text("   no images found in the folder!", "Red"))
+    segment = segment.lower()
+    return any(keyword in segment for keyword in GPS_KEYWORDS)
+
+
+def make_segment(marker: int, segment: bytes) -> bytes:
+    """
+    Returns the jpeg segment with the marker and the length in front of the segment data
+    """
 
-    return img_filename_list, img_transformation_list
+    if len(segment) + 2 > 0xFFFF:
+        raise ValueError("jpeg segment is too large")
 
+    return bytes((0xFF, marker)) + (len(segment) + 2).to_bytes(2, 'big') + segment
 
-def remove_gps_information(path: str) -> None:
+
+def remove_gps(file_path: str, file_path_output: str) -> None:
     """
-    Removes the GPS data from the images in the given folder and stores them in a subdirectory gps_removed
+    Writes the jpeg image without the GPS data to file_path_output. The exif segment is replaced by one without
+    the GPS directory and the xmp and other APPn segments that carry the location are dropped, the remaining
+    segments and the compressed image data are copied without re-encoding
+    """
+
+    exif_dict = piexif.load(file_path)
+    del exif_dict["GPS"]
+    exif_segment = piexif.dump(exif_dict)
+
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(JPEG_SOI):
+        raise ValueError("not a jpeg file")
+
+    segments = [JPEG_SOI]
+    is_exif_written = False
+    position = len(JPEG_SOI)
+    while True:
+        if position + 4 > len(data) or data[position] != 0xFF:
+            raise ValueError("corrupt jpeg segment")
+
+        marker = data[position + 1]
+        if marker in (JPEG_SOS, JPEG_EOI):
+            break
+
+        length = int.from_bytes(data[position + 2:position + 4], 'big')
+        segment = data[position + 4:position + 2 + length]
+        if marker == JPEG_APP1 and segment.startswith(EXIF_HEADER):
+            if not is_exif_written:
+                segments.append(make_segment(JPEG_APP1, exif_segment))
+                is_exif_written = True
+        elif not is_location_segment(marker, segment):
+            segments.append(data[position:position + 2 + length])
+        position += 2 + length
+
+    # the exif segment follows a leading APP0 (JFIF) segment
+    if not is_exif_written:
+        segments.insert(2 if data[3] == JPEG_APP0 else 1, make_segment(JPEG_APP1, exif_segment))
+    segments.append(data[position:])
+
+    with open(file_path_output, 'wb') as f:
+        f.write(b''.join(segments))
+
+
+def remove_gps_information(path: str, num_workers: int = 8) -> None:
+    """
+    Removes the GPS data from the images in the given folder with num_workers threads and stores them in a
+    subdirectory gps_removed
     """
 
     path = os.path.join(path, "images")
 
     path_sub_dir = helper.create_subdir_if_not_exists(path, "gps_removed")
 
-    file_cntr = 0
-    for file_name in os.listdir(path):
-        try:
-            img = Image.open(os.path.join(path, file_name))
-            exif_dict = piexif.load(img.info['exif'])
-            del exif_dict["GPS"]
-            exif_bytes = piexif.dump(exif_dict)
-            img.save(os.path.join(path_sub_dir, file_name), "jpeg", exif=exif_bytes)
-            file_cntr += 1
-            print(f"   {file_name} saved with gps removed")
-        except:
-            pass
-
-    if file_cntr == 0:
+    file_names = get_image_file_names(path)
+    results, _ = helper.process_files(remove_gps, file_names,
+                                      [(os.path.join(path, file_name), os.path.join(path_sub_dir, file_name))
+                                       for file_name in file_names],
+                                      num_workers, description="saved with gps removed")
+
+    if len(results) == 0:
         print(textcolor.colored_text("   no images found in the folder!", "Red"))
 
 
-def embed_pose_information(path: str,
-                           file_name: str = 'calibrated_external_camera_parameters.txt',
-                           t: np.array = np.identity(4)) -> None:
+# align the camera frame so that x is pointing towards the scene, y points left and z up
+R_CC = np.array([[0, -1, 0], [0, 0, 1], [-1, 0, 0]], dtype=np.float64)
+
+
+def compute_camera_poses(data_table: pd.DataFrame, t: np.array = np.identity(4)) -> (np.array, np.array):
     """
-    Embeds the pose information from the given coordinates file into the images in the given folder and stores
-    them in a subdirectory pose_embedded
+    Computes the positions and orientations w.r.t. (R) of all cameras of the Pix4D table in one batch,
+    returns a Nx3 array of positions and a Nx4 array of quaternions [w, x, y, z] with w >= 0
     """
 
-    path = os.path.join(path, "images")
+    # positions w.r.t. (M) and (R)
+    pos_i = transformations.apply_transformation_to_points(data_table[['X', 'Y', 'Z']].to_numpy(dtype=np.float64), t,
+                                                           in_place=True)
 
-    path_sub_dir = helper.create_subdir_if_not_exists(path, "pose_embedded")
+    # rotations w.r.t. (M)
+    # see: https://support.pix4d.com/hc/en-us/articles/202558969-Yaw-Pitch-Roll-and-Omega-Phi-Kappa-angles
+    r_i = Rotation.from_euler('zyx', data_table[['Kappa', 'Phi', 'Omega']].to_numpy(dtype=np.float64), degrees=True)
 
-    # aling camera frame so that x is pointing towards scene, y points left and z up
-    quat_cc = Quaternion(matrix=np.array([[0, -1, 0], [0, 0, 1], [-1, 0, 0]]))
+    # rotate the camera frame and express the orientations w.r.t. (R)
+    r_i = Rotation.from_matrix(transformations.apply_transformation_to_rotations(r_i.as_matrix().reshape(-1, 3, 3) @ R_CC,
+                                                                                 t))
 
-    r_rm = t[0:3, 0:3]
-    pos_rm = t[0:3, 3]
-    quat_rm = Quaternion(matrix=r_rm)
+    # scipy orders the quaternions [x, y, z, w]
+    quat_i = np.roll(r_i.as_quat().reshape(-1, 4), 1, axis=1)
+    quat_i[quat_i[:, 0] < 0] *= -1.0
 
-    # normalise quaternions
-    quat_cc = quat_cc.normalised
-    quat_rm = quat_rm.normalised
+    return pos_i, quat_i
 
-    # check if the file exists in the path
-    file_was_found = helper.does_file_name_exist_in_path(path, file_name)
-    if not file_was_found:
-        print(f"   no {file_name} file was found")
-        return
 
-    file_cntr = 0
-    data_table = pd.read_csv(os.path.join(path, file_name), sep=" ")  # extract data as a table
-    for index, row in data_table.iterrows():
-        img_name = row['imageName']
+def convert_poses_to_transformations(positions: np.array, quaternions: np.array) -> np.array:
+    """
+    Converts Nx3 positions and Nx4 quaternions [w, x, y, z] to a Nx4x4 array of transformation matrices
+    """
+
+    poses = np.tile(np.identity(4), (len(positions), 1, 1))
+    poses[:, 0:3, 0:3] = Rotation.from_quat(np.roll(quaternions, -1, axis=1)).as_matrix()
+    poses[:, 0:3, 3] = positions
+
+    return poses
+
+
+def embed_pose(file_path: str, file_path_output: str, pos_i: np.array, quat_i: np.array) -> None:
+    """
+    Writes the jpeg image with the pose embedded in the UserComment to file_path_output
+    """
+
+    user_str = f"{[pos_i[0], pos_i[1], pos_i[2], -quat_i[0], -quat_i[1], -quat_i[2], -quat_i[3]]}"
 
-        try:
-            # position w.r.t to (M)
-            pos_i = np.array(row[['X', 'Y', 'Z']])
+    # extract exif directory
+    exif_dict = piexif.load(file_path)
 
-            # rotation w.r.t. (M)
-            # see: https://support.pix4d.com/hc/en-us/articles/202558969-Yaw-Pitch-Roll-and-Omega-Phi-Kappa-angles
-            quat_i = Quaternion(
-                matrix=Rotation.from_euler('zyx', row[['Kappa', 'Phi', 'Omega']].to_numpy(), degrees=True).as_matrix())
-            quat_i = quat_i.normalised
+    # create and insert user_comment
+    user_comment = piexif.helper.UserComment.dump(user_str, encoding="ascii")
+    exif_dict["Exif"][piexif.ExifIFD.UserComment] = user_comment
 
-            # position w.r.t. (R)
-            pos_i = pos_rm + quat_rm.rotate(pos_i)
+    # write the image with the new exif
+    write_exif(file_path, file_path_output, exif_dict)
 
-            # rotate so that camera frame x is pointing towards scene, y points left and z up
-            quat_i = quat_i * quat_cc
 
-            # orientation w.r.t. (R)
-            quat_i = quat_rm * quat_i
+def embed_pose_information(path: str,
+                           file_name: str = 'calibrated_external_camera_parameters.txt',
+                           t: np.array = np.identity(4),
+                           num_workers: int = 8) -> None:
+    """
+    Embeds the pose information from the given coordinates file into the images in the given folder with
+    num_workers threads and stores them in a subdirectory pose_embedded
+    """
 
-            # try to add information in user_comment
-            user_str = f"{[pos_i[0], pos_i[1], pos_i[2], -quat_i[0], -quat_i[1], -quat_i[2], -quat_i[3]]}"
+    path = os.path.join(path, "images")
 
-            # open file with Pillow an extract exif directory
-            img = Image.open(os.path.join(path, img_name))
-            exif_dict = piexif.load(img.info["exif"])
+    path_sub_dir = helper.create_subdir_if_not_exists(path, "pose_embedded")
 
-            # create and insert user_comment
-            user_comment = piexif.helper.UserComment.dump(user_str, encoding="ascii")
-            exif_dict["Exif"][piexif.ExifIFD.UserComment] = user_comment
+    # check if the file exists in the path
+    file_was_found = helper.does_file_name_exist_in_path(path, file_name)
+    if not file_was_found:
+        print(f"   no {file_name} file was found")
+        return
 
-            # create exif_bytes that goes along with the image and overwrite the image
-            exif_bytes = piexif.dump(exif_dict)
+    data_table = pd.read_csv(os.path.join(path, file_name), sep=" ")  # extract data as a table
 
-            img.save(os.path.join(path_sub_dir, img_name), "jpeg", exif=exif_bytes)
-            print(f"   {img_name} saved with pose embedded")
-            file_cntr += 1
-            
-            # #  TODO: remove me
-            # if file_cntr == 5:
-            #     break
+    # compute the poses of all images at once
+    positions, quaternions = compute_camera_poses(data_table, t)
 
-        except:
-            pass
+    img_names = list(data_table['imageName'])
+    results, _ = helper.process_files(embed_pose, img_names,
+                                      [(os.path.join(path, img_name), os.path.join(path_sub_dir, img_name),
+                                        positions[i], quaternions[i]) for i, img_name in enumerate(img_names)],
+                                      num_workers, description="saved with pose embedded")
 
-    if file_cntr == 0:
+    if len(results) == 0:
         print(textcolor.colored_text("   no images found in the folder!", "Red"))
+        return
+
+    # the sidecar holds the poses as they are embedded in the images
+    rows = [i for i, img_name in enumerate(img_names) if img_name in results]
+    write_pose_sidecar(path_sub_dir, PoseTable([img_names[i] for i in rows], positions[rows], -quaternions[rows]))
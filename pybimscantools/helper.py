@@ -1,4 +1,9 @@
+import hashlib
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from pybimscantools import textcolor
 
 
 def does_file_name_exist_in_path(path: str, file_name: str) -> bool:
@@ -22,6 +27,68 @@ def create_subdir_if_not_exists(path: str, sub_dir_name: str) -> str:
         os.mkdir(sub_dir)
     return sub_dir
 
+def get_file_hash(file_path: str, block_size: int = 2 ** 20) -> str:
+    """
+    Function that takes a file path and returns the sha256 hash of the file content, the file is read in blocks
+    """
+
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def try_call(function, arguments: tuple) -> (object, str):
+    """
+    Function that calls function(*arguments) and returns the result and None or None and the error message
+    """
+
+    try:
+        return function(*arguments), None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
+def process_files(function,
+                  file_names: list,
+                  arguments: list,
+                  num_workers: int = 8,
+                  use_processes: bool = False,
+                  description: str = "processed") -> (dict, dict):
+    """
+    Function that calls function(*arguments[i]) for every file_names[i] concurrently, I/O bound work runs in a
+    thread pool and with use_processes CPU bound work runs in a process pool. The errors of every file are captured
+    and reported with a summary. Returns the results of the successful files and the errors of the failed ones.
+    """
+
+    if num_workers > 1 and len(file_names) > 1:
+        if use_processes:
+            # spawn the workers, forking a process that already runs threads can dead lock
+            executor = ProcessPoolExecutor(max_workers=min(num_workers, len(file_names)),
+                                           mp_context=multiprocessing.get_context("spawn"))
+        else:
+            executor = ThreadPoolExecutor(max_workers=min(num_workers, len(file_names)))
+        with executor:
+            outcomes = list(executor.map(try_call, [function] * len(file_names), arguments))
+    else:
+        outcomes = [try_call(function, file_arguments) for file_arguments in arguments]
+
+    results = {}
+    errors = {}
+    for file_name, (result, error) in zip(file_names, outcomes):
+        if error is None:
+            results[file_name] = result
+        else:
+            errors[file_name] = error
+            print(textcolor.colored_text(f"   {file_name} failed: {error}", "Red"))
+
+    if len(file_names) > 0:
+        print(f"   {len(results)} of {len(file_names)} files {description}")
+
+    return results, errors
+
+
 # def remove_and_create_subdir(path: str, sub_dir_name: str) -> str:
 #     """
 #     Function that takes a path and a sub_dir_name and creates a subdirectory if it does not exist
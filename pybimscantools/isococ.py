@@ -1189,9 +1189,7 @@ class ISOCoC:
                 # and make polygons out of them and union them together
                 unioned_polygon = None
                 for i in range(0, coordinate.len()):
-                    read_out_coor = []
-                    for j in range(0, coordinate.get_coordinate_list(i).len()):
-                        read_out_coor.append(coordinate.get_coordinate_list(i).get_coordinate(j))
+                    read_out_coor = coordinate.get_coordinate_list(i).get_array().tolist()
                     read_out_polygon = Polygon([(x, y) for x, y, _ in read_out_coor])
                     if i == 0:
                         unioned_polygon = read_out_polygon
@@ -0,0 +1,194 @@
+""" This file contains a streaming writer for *.kml and *.kmz files that serialises extruded polygons
+directly from coordinate arrays, the document is never built in memory
+"""
+
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from pybimscantools import reframe
+from pybimscantools import textcolor
+
+
+KML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+              '<kml xmlns="http://www.opengis.net/kml/2.2" xmlns:gx="http://www.google.com/kml/ext/2.2">\n'
+              '    <Document>\n')
+KML_FOOTER = ('    </Document>\n'
+              '</kml>\n')
+KMZ_DOCUMENT_NAME = 'doc.kml'
+
+
+def get_kml_color(hex_color: str) -> str:
+    """
+    Returns the kml color aabbggrr of a hex color rrggbb without alpha
+    """
+
+    return f"ff{hex_color[4:6]}{hex_color[2:4]}{hex_color[0:2]}"
+
+
+def transform_to_google_earth(coordinates: np.array, altitudes: np.array) -> np.array:
+    """
+    Returns the lv95 coordinates transformed to etrf93 geographic with the given altitudes as 3rd column
+    """
+
+    coordinates_google_earth = reframe.transform_coordinates(coordinates, reframe.LV95_TO_ETRF93_GEOGRAPHIC)
+    coordinates_google_earth[:, 2] = altitudes
+
+    return coordinates_google_earth
+
+
+class KmlWriter:
+    """
+    KmlWriter class that streams extruded polygons into a *.kml file or, for file names ending in *.kmz,
+    into the doc.kml of a zip archive
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        self.nr_polygons = 0
+        self.__styles = set()
+        self.__zip_file = None
+        if file_path.lower().endswith('.kmz'):
+            self.__zip_file = zipfile.ZipFile(file_path, 'w', compression=zipfile.ZIP_DEFLATED)
+            self.__file = io.TextIOWrapper(self.__zip_file.open(KMZ_DOCUMENT_NAME, 'w'), encoding='utf-8')
+        else:
+            self.__file = open(file_path, 'w', encoding='utf-8')
+        self.__file.write(KML_HEADER)
+
+    def __enter__(self) -> 'KmlWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """
+        Write the end of the document and close the file
+        """
+        if self.__file is None:
+            return
+
+        self.__file.write(KML_FOOTER)
+        self.__file.close()
+        self.__file = None
+        if self.__zip_file is not None:
+            self.__zip_file.close()
+            self.__zip_file = None
+
+    def __write_style(self, hex_color: str) -> str:
+        """
+        Write the style of the polygons with the given color the first time it is used and return its id
+        """
+        style_id = f"polygon_{hex_color}"
+        if style_id not in self.__styles:
+            self.__file.write(f'        <Style id="{style_id}">\n'
+                              f'            <PolyStyle>\n'
+                              f'                <color>{get_kml_color(hex_color)}</color>\n'
+                              f'            </PolyStyle>\n'
+                              f'        </Style>\n')
+            self.__styles.add(style_id)
+
+        return style_id
+
+    def write_polygon(self, name: str, coordinates: np.array, hex_color: str) -> None:
+        """
+        Write an extruded polygon with absolute altitudes, the ring is closed without changing the coordinates
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+        if len(coordinates) == 0:
+            return
+
+        style_id = self.__write_style(hex_color)
+        ring = coordinates.tolist()
+        ring.append(ring[0])
+        self.__file.write(f'        <Placemark>\n'
+                          f'            <name>{escape(name)}</name>\n'
+                          f'            <styleUrl>#{style_id}</styleUrl>\n'
+                          f'            <Polygon>\n'
+                          f'                <extrude>1</extrude>\n'
+                          f'                <altitudeMode>absolute</altitudeMode>\n'
+                          f'                <outerBoundaryIs>\n'
+                          f'                    <LinearRing>\n'
+                          f'                        <coordinates>'
+                          f'{" ".join(f"{x},{y},{z}" for x, y, z in ring)}'
+                          f'</coordinates>\n'
+                          f'                    </LinearRing>\n'
+                          f'                </outerBoundaryIs>\n'
+                          f'            </Polygon>\n'
+                          f'        </Placemark>\n')
+        self.nr_polygons += 1
+
+    def write_polygons(self, names: list,
+                       coordinates: np.array,
+                       offsets: np.array,
+                       hex_color_indices: list) -> None:
+        """
+        Write the polygons stored as one concatenated Nx3 array with the offsets of every polygon
+        """
+        for i, name in enumerate(names):
+            self.write_polygon(name, coordinates[offsets[i]:offsets[i + 1]],
+                               textcolor.HEX_COLOR_LIST[hex_color_indices[i] % len(textcolor.HEX_COLOR_LIST)])
+
+    def write_coordinate_model(self, coordinate_model,
+                               name: str,
+                               do_transform_to_google_earth: bool = False,
+                               chunk_size: int = 1000,
+                               num_workers: int = 1) -> None:
+        """
+        Write every CoordinateList of the CoordinateModel as an extruded polygon name_<i>. With
+        do_transform_to_google_earth the lv95 coordinates are transformed to google earth chunk by chunk of
+        chunk_size polygons on the fly, the CoordinateModel is left unchanged. With num_workers > 1 the chunks
+        are transformed concurrently in a process pool.
+        """
+        coordinates, offsets = coordinate_model.get_arrays()
+        nr_polygons = len(offsets) - 1
+        chunks = [(start, min(start + chunk_size, nr_polygons)) for start in range(0, nr_polygons, chunk_size)]
+        names = [f"{name}_{i}" for i in range(nr_polygons)]
+        hex_color_indices = list(range(nr_polygons))
+
+        if not do_transform_to_google_earth:
+            self.write_polygons(names, coordinates, offsets, hex_color_indices)
+            return
+
+        altitudes = coordinates[:, 2] + np.repeat(coordinate_model.get_heights(), np.diff(offsets))
+        chunk_arguments = [(coordinates[offsets[start]:offsets[end]], altitudes[offsets[start]:offsets[end]])
+                           for start, end in chunks]
+
+        def write_chunk(chunk_nr: int, coordinates_chunk: np.array) -> None:
+            start, end = chunks[chunk_nr]
+            self.write_polygons(names[start:end], coordinates_chunk, offsets[start:end + 1] - offsets[start],
+                                hex_color_indices[start:end])
+
+        if num_workers > 1 and len(chunks) > 1:
+            # spawn the workers, every worker initialises its own swissreframe backend
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(chunks)),
+                                     mp_context=multiprocessing.get_context("spawn")) as executor:
+                for chunk_nr, coordinates_chunk in enumerate(executor.map(transform_to_google_earth,
+                                                                          *zip(*chunk_arguments))):
+                    write_chunk(chunk_nr, coordinates_chunk)
+        else:
+            for chunk_nr, arguments in enumerate(chunk_arguments):
+                write_chunk(chunk_nr, transform_to_google_earth(*arguments))
+
+
+def write_kml(file_path: str, coordinate_model,
+              name: str = None,
+              do_transform_to_google_earth: bool = False,
+              chunk_size: int = 1000,
+              num_workers: int = 1) -> None:
+    """
+    Writes the CoordinateModel as extruded polygons to a *.kml or *.kmz file
+    """
+
+    if name is None:
+        name = os.path.splitext(os.path.basename(file_path))[0]
+
+    with KmlWriter(file_path) as writer:
+        writer.write_coordinate_model(coordinate_model, name, do_transform_to_google_earth, chunk_size, num_workers)
+
+    print(f"   {writer.nr_polygons} polygons written to {os.path.basename(file_path)}")
@@ -10,6 +10,23 @@ from pybimscantools import helper
 from pybimscantools import transformations
 
 
+MARKER_INDEX_FILE_NAME = 'markers_index.json'
+MARKER_COLUMNS = {'project_name': 'str',
+                  'project_information': 'str',
+                  'version': 'str',
+                  'marker_nr': 'int',
+                  'valid': 'bool',
+                  'pcs_description': 'str',
+                  'l_x': 'float',
+                  'l_y': 'float',
+                  'l_z': 'float',
+                  'r_x': 'float',
+                  'r_y': 'float',
+                  'r_z': 'float',
+                  'measured_date': 'str',
+                  'contact_person': 'str'}
+
+
 def apply_transformation_matrix_to_markers_xlsx_and_copy(path: str,
                                                          t: np.array = np.identity(4),
                                                          file_name: str = 'markers.xlsx',
@@ -41,12 +58,13 @@ def apply_transformation_matrix_to_markers_xlsx_and_copy(path: str,
     sheet['C2'] = pcs_description
 
     last_row = sheet.max_row
-    markers_left = np.array([[sheet.cell(row=i, column=j).value for j in range(5, 8)] for i in range(4, last_row + 1)])
-    markers_right = np.array([[sheet.cell(row=i, column=j).value for j in range(2, 5)] for i in range(4, last_row + 1)])
+    markers_left = np.array([[sheet.cell(row=i, column=j).value for j in range(5, 8)] for i in range(4, last_row + 1)],
+                            dtype=np.float64).reshape(-1, 3)
+    markers_right = np.array([[sheet.cell(row=i, column=j).value for j in range(2, 5)] for i in range(4, last_row + 1)],
+                             dtype=np.float64).reshape(-1, 3)
 
-    for i in range(len(markers_left)):
-        markers_left[i] = t[0:3, 0:3].dot(markers_left[i]) + t[0:3, 3]
-        markers_right[i] = t[0:3, 0:3].dot(markers_right[i]) + t[0:3, 3]
+    transformations.apply_transformation_to_points(markers_left, t, in_place=True)
+    transformations.apply_transformation_to_points(markers_right, t, in_place=True)
 
     for i in range(markers_right.shape[0]):
         for j in range(markers_right.shape[1]):
@@ -110,51 +128,104 @@ def convert_markers_from_xlsx_to_json(path: str,
             json.dump(data, json_file, indent=4)
 
 
-def read_markers_from_json_to_table(path: str) -> pd.DataFrame:
+def read_marker_json(file_path: str) -> dict:
+    """
+    Reads a marker_nr_*.json file and returns its data as one row of the marker table
+    """
+
+    with open(file_path, 'r', encoding="utf-8") as json_file:
+        data = json.load(json_file)
+
+    row = {column: data[column] for column in MARKER_COLUMNS if column in data}
+    row['l_x'], row['l_y'], row['l_z'] = data['l_xyz']
+    row['r_x'], row['r_y'], row['r_z'] = data['r_xyz']
+
+    return row
+
+
+def read_marker_index(path: str, file_name: str = MARKER_INDEX_FILE_NAME) -> dict:
+    """
+    Reads the markers index of the given folder and returns the rows of the marker_nr_*.json files that did not
+    change since the index was written, None if there is no index
+    """
+
+    if not os.path.isfile(os.path.join(path, file_name)):
+        return None
+
+    with open(os.path.join(path, file_name), 'r', encoding="utf-8") as json_file:
+        marker_index = json.load(json_file)
+
+    rows = {}
+    for entry in marker_index["markers"]:
+        file_path = os.path.join(path, entry["file_name"])
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            if stat.st_size == entry["size"] and stat.st_mtime_ns == entry["mtime_ns"]:
+                rows[entry["file_name"]] = entry["row"]
+
+    return rows
+
+
+def write_marker_index(path: str, rows: dict, file_name: str = MARKER_INDEX_FILE_NAME) -> None:
+    """
+    Writes the rows of the marker_nr_*.json files of the given folder with the size and modification time of
+    every file to the markers index
+    """
+
+    entries = []
+    for marker_file_name, row in rows.items():
+        stat = os.stat(os.path.join(path, marker_file_name))
+        entries.append({"file_name": marker_file_name,
+                        "size": stat.st_size,
+                        "mtime_ns": stat.st_mtime_ns,
+                        "row": row})
+
+    with open(os.path.join(path, file_name), 'w', encoding="utf-8") as json_file:
+        json.dump({"markers": entries}, json_file, indent=4)
+
+
+def read_markers_from_json_to_table(path: str, num_workers: int = 8, do_use_index: bool = False) -> pd.DataFrame:
     """
     Takes a list of marker_nr_*.json files and converts it to a pandas DataFrame.
     It is assumed that the marker_nr_*.json files exist in the directory path/markers/json.
+    The files are read concurrently with num_workers threads. With do_use_index the rows are loaded from the
+    markers index and only the files that are new or changed since the index was written are read, the index
+    is updated afterwards. A ValueError is raised if a file cannot be read or parsed.
     """
 
     path = os.path.join(path, "markers/json")
 
-    index = 0
-    marker_table = pd.DataFrame({'project_name': pd.Series(dtype='str'),
-                                 'project_information': pd.Series(dtype='str'),
-                                 'version': pd.Series(dtype='str'),
-                                 'marker_nr': pd.Series(dtype='str'),
-                                 'valid': pd.Series(dtype='bool'),
-                                 'pcs_description': pd.Series(dtype='str'),
-                                 'l_x': pd.Series(dtype='float'),
-                                 'l_y': pd.Series(dtype='float'),
-                                 'l_z': pd.Series(dtype='float'),
-                                 'r_x': pd.Series(dtype='float'),
-                                 'r_y': pd.Series(dtype='float'),
-                                 'r_z': pd.Series(dtype='float'),
-                                 'measured_date': pd.Series(dtype='str'),
-                                 'contact_person': pd.Series(dtype='str')})
-    for file in os.listdir(path):
-        if file[0:10] == "marker_nr_":  # marker_nr_
-            marker_i_table = pd.read_json(os.path.join(path, file), orient='records')
-
-            # write all the data to one single row
-            marker_table.at[index, 'project_name'] = marker_i_table.at[0, 'project_name']
-            marker_table.at[index, 'project_information'] = marker_i_table.at[0, 'project_information']
-            marker_table.at[index, 'version'] = marker_i_table.at[0, 'version']
-            marker_table.at[index, 'marker_nr'] = marker_i_table.at[0, 'marker_nr']
-            marker_table.at[index, 'valid'] = marker_i_table.at[0, 'valid']
-            marker_table.at[index, 'pcs_description'] = marker_i_table.at[0, 'pcs_description']
-            marker_table.at[index, 'l_x'] = marker_i_table.at[0, 'l_xyz']
-            marker_table.at[index, 'l_y'] = marker_i_table.at[1, 'l_xyz']
-            marker_table.at[index, 'l_z'] = marker_i_table.at[2, 'l_xyz']
-            marker_table.at[index, 'r_x'] = marker_i_table.at[0, 'r_xyz']
-            marker_table.at[index, 'r_y'] = marker_i_table.at[1, 'r_xyz']
-            marker_table.at[index, 'r_z'] = marker_i_table.at[2, 'r_xyz']
-            marker_table.at[index, 'measured_date'] = marker_i_table.at[0, 'measured_date']
-            marker_table.at[index, 'contact_person'] = marker_i_table.at[0, 'contact_person']
-            index = index + 1
-
-    if index == 0:
+    file_names = sorted(file for file in os.listdir(path) if file[0:10] == "marker_nr_")  # marker_nr_
+
+    rows = {}
+    if do_use_index:
+        rows = read_marker_index(path)
+        if rows is None:
+            rows = {}
+    file_names_to_read = [file_name for file_name in file_names if file_name not in rows]
+
+    results = {}
+    errors = {}
+    if len(file_names_to_read) > 0:
+        results, errors = helper.process_files(read_marker_json, file_names_to_read,
+                                               [(os.path.join(path, file_name),) for file_name in file_names_to_read],
+                                               num_workers, description="read")
+
+    rows = {file_name: results[file_name] if file_name in results else rows[file_name]
+            for file_name in file_names if file_name in rows or file_name in results}
+    if do_use_index and (len(results) > 0 or len(rows) != len(file_names)):
+        write_marker_index(path, rows)
+
+    # a missing marker would silently change the transformations estimated from the table
+    if errors:
+        raise ValueError(f"read_markers_from_json_to_table(): {len(errors)} marker files could not be read: "
+                         + ", ".join(f"{file_name} ({error})" for file_name, error in errors.items()))
+
+    # build the table column by column
+    marker_table = pd.DataFrame({column: pd.Series([row.get(column) for row in rows.values()], dtype=dtype)
+                                 for column, dtype in MARKER_COLUMNS.items()})
+
+    if len(rows) == 0:
         print("   no marker_nr_*.json files were found")
         return marker_table
 
@@ -170,12 +241,10 @@ def apply_transformation_matrix_to_marker_table(marker_table: pd.DataFrame,
     Transform an existing marker table with a transformation matrix T and return the transformed marker table.
     """
 
-    markers_left = marker_table[['l_x', 'l_y', 'l_z']].to_numpy()
-    markers_right = marker_table[['r_x', 'r_y', 'r_z']].to_numpy()
-
-    for i in range(len(markers_left)):
-        markers_left[i] = t[0:3, 0:3].dot(markers_left[i]) + t[0:3, 3]
-        markers_right[i] = t[0:3, 0:3].dot(markers_right[i]) + t[0:3, 3]
+    markers_left = transformations.apply_transformation_to_points(
+        marker_table[['l_x', 'l_y', 'l_z']].to_numpy(dtype=np.float64), t, in_place=True)
+    markers_right = transformations.apply_transformation_to_points(
+        marker_table[['r_x', 'r_y', 'r_z']].to_numpy(dtype=np.float64), t, in_place=True)
 
     marker_table[['l_x', 'l_y', 'l_z']] = markers_left
     marker_table[['r_x', 'r_y', 'r_z']] = markers_right
@@ -225,14 +294,13 @@ def get_chilli_tag_corners_from_table_as_list(chilli_tag_table: pd.DataFrame) ->
     Takes a tag_corners.json file and converts it to a list of corner points.
     """
 
-    corner_point_list = []
-    for marker_nr in np.unique(np.sort(chilli_tag_table["marker_nr"])):
-        sub_table = chilli_tag_table[chilli_tag_table["marker_nr"] == marker_nr]
-        x = sub_table["x"].values
-        y = sub_table["y"].values
-        z = sub_table["z"].values
-        for i in range(len(x)):
-            corner_point_list.append([x[i], y[i], z[i]])
+    # rows of every marker in the order of increasing marker number, the order within a marker is kept
+    marker_rows = chilli_tag_table.groupby("marker_nr", sort=True).indices
+    if len(marker_rows) == 0:
+        return []
+
+    rows = np.concatenate(list(marker_rows.values()))
+    corner_point_list = chilli_tag_table[["x", "y", "z"]].to_numpy()[rows].tolist()
 
     return corner_point_list
 
@@ -253,22 +321,24 @@ def create_tag_corners_json(path: str,
     marker_nr = marker_table['marker_nr'].to_numpy()
     relative_corners = corner_table[['rel_cc_x', 'rel_cc_y', 'rel_cc_z']].to_numpy()
 
-    tags = np.zeros((markers_right.shape[0] * 4, 5))
+    nr_markers = markers_right.shape[0]
+    nr_corners = relative_corners.shape[0]
 
-    for j in range(markers_right.shape[0]):
+    # calculate the rotation matrices of all markers, the columns are the axes x, y and z
+    axis_x = markers_left - markers_right
+    axis_y = np.column_stack((-axis_x[:, 1], axis_x[:, 0], np.zeros(nr_markers)))
+    axis_x = axis_x / np.linalg.norm(axis_x, axis=1, keepdims=True)
+    axis_y = axis_y / np.linalg.norm(axis_y, axis=1, keepdims=True)
+    axis_z = np.cross(axis_x, axis_y)
+    r = np.stack((axis_x, axis_y, axis_z), axis=2)
 
-        # calculate rotation matrix
-        axis_x = (markers_left[j, :] - markers_right[j, :])
-        axis_y = np.array([-axis_x[1], axis_x[0], 0])
-        axis_x = axis_x / np.linalg.norm(axis_x)
-        axis_y = axis_y / np.linalg.norm(axis_y)
-        axis_z = np.cross(axis_x, axis_y)
-        r = np.vstack([axis_x, axis_y, axis_z]).transpose()
+    # rotate the relative corners of every marker and shift them to the right marker point
+    corners = np.einsum('mij,cj->mci', r, relative_corners) + markers_right[:, None, :]
 
-        for i in range(relative_corners.shape[0]):
-            tags[(j * 4) + i, 0] = marker_nr[j]
-            tags[(j * 4) + i, 1] = i
-            tags[(j * 4) + i, 2:5] = (r @ relative_corners[i, :].transpose() + markers_right[j, :]).transpose()
+    tags = np.zeros((nr_markers * nr_corners, 5))
+    tags[:, 0] = np.repeat(marker_nr, nr_corners)
+    tags[:, 1] = np.tile(np.arange(nr_corners), nr_markers)
+    tags[:, 2:5] = corners.reshape(-1, 3)
 
     tag_table = pd.DataFrame(tags, columns=['marker_nr', 'corner_nr', 'x', 'y', 'z'])
 
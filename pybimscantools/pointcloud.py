@@ -1,30 +1,445 @@
+import copy
+import json
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import laspy
 
 from pybimscantools import helper
 from pybimscantools import textcolor
+from pybimscantools import transformations
 
 
-def transform_pointclouds(path: str, t: np.array = np.identity(4)) -> None:
+POINTCLOUD_EXTENSIONS = ('.las', '.laz')
+POINTCLOUD_FORMATS = ('las', 'laz')
+PROFILE_SUFFIX = '_profile.json'
+DENSITY_SUFFIX = '_density.npy'
+NR_HISTOGRAM_BINS = 64
+MAX_DENSITY_CELLS = 4_000_000
+
+# dimensions copied by the in memory transformation of transform_pointcloud
+LEGACY_DIMENSIONS = ('intensity', 'return_number', 'number_of_returns', 'scan_direction_flag', 'edge_of_flight_line',
+                     'classification', 'scan_angle_rank', 'user_data', 'point_source_id')
+
+
+def get_laz_backend() -> laspy.LazBackend:
+    """
+    Returns the laz backend used to read and write *.laz files, the parallel lazrs backend is preferred
+    """
+
+    available_backends = laspy.LazBackend.detect_available()
+    if len(available_backends) == 0:
+        return None
+
+    return available_backends[0]
+
+
+def read_pointcloud(file_path: str) -> laspy.LasData:
+    """
+    Reads a pointcloud in *.las or *.laz format, *.laz files are decompressed with the laz backend
+    """
+
+    return laspy.read(file_path, laz_backend=get_laz_backend())
+
+
+def open_pointcloud(file_path: str) -> laspy.LasReader:
+    """
+    Opens a pointcloud in *.las or *.laz format for reading it chunk by chunk
+    """
+
+    return laspy.open(file_path, laz_backend=get_laz_backend())
+
+
+def get_profile_file_paths(file_path: str) -> (str, str):
     """
-    Transforms the pointclouds in *.las format in the given folder and stores them in the subdirectory transformed
+    Returns the paths of the cached profile and density grid stored next to the pointcloud
     """
 
-    file_cntr = 0
-    for file_name in os.listdir(os.path.join(path, "pointclouds")):
-        if file_name.endswith(".las"):
-            transform_pointcloud(path, file_name, t)
-            file_cntr += 1
+    file_path_stem = os.path.splitext(file_path)[0]
+
+    return file_path_stem + PROFILE_SUFFIX, file_path_stem + DENSITY_SUFFIX
+
+
+def profile_pointcloud(file_path: str, chunk_size: int = 1_000_000, cell_size: float = 1.0) -> dict:
+    """
+    Streams the pointcloud chunk by chunk and computes its bounds, the point count per classification,
+    histograms of z and intensity, the presence of color and gps time and a density grid of the points
+    per cell_size x cell_size cell. The cell size is doubled until the grid has at most MAX_DENSITY_CELLS cells.
+    The profile is cached as <name>_profile.json and the density grid as <name>_density.npy next to the pointcloud.
+    """
+
+    with open_pointcloud(file_path) as reader:
+        header = reader.header
+        dimension_names = list(header.point_format.dimension_names)
+        has_rgb = all(name in dimension_names for name in ('red', 'green', 'blue'))
+
+        # the grid and the histograms span the header extent, large extents get a coarser grid
+        density_cell_size = cell_size
+        nr_cells = np.maximum(np.ceil((header.maxs[0:2] - header.mins[0:2]) / density_cell_size), 1).astype(np.int64)
+        while nr_cells[0] * nr_cells[1] > MAX_DENSITY_CELLS:
+            density_cell_size *= 2.0
+            nr_cells = np.maximum(np.ceil((header.maxs[0:2] - header.mins[0:2]) / density_cell_size),
+                                  1).astype(np.int64)
+        if density_cell_size != cell_size:
+            print(textcolor.colored_text(f"   the density grid of {os.path.basename(file_path)} is coarsened to "
+                                         f"{density_cell_size} m cells", "Orange"))
+        density = np.zeros(nr_cells[0] * nr_cells[1], dtype=np.int64)
+        z_bins = np.linspace(header.z_min, max(header.z_max, header.z_min + header.scales[2]), NR_HISTOGRAM_BINS + 1)
+        z_histogram = np.zeros(NR_HISTOGRAM_BINS, dtype=np.int64)
+        intensity_bins = np.linspace(0, 65536, NR_HISTOGRAM_BINS + 1)
+        intensity_histogram = np.zeros(NR_HISTOGRAM_BINS, dtype=np.int64)
+        classification_counts = np.zeros(256, dtype=np.int64)
+        mins = np.full(3, np.inf)
+        maxs = np.full(3, -np.inf)
+        point_count = 0
+        nr_colored_points = 0
+        nr_points_with_gps_time = 0
+
+        for points in reader.chunk_iterator(chunk_size):
+            x = np.asarray(points.x)
+            y = np.asarray(points.y)
+            z = np.asarray(points.z)
+            point_count += len(x)
+            mins = np.minimum(mins, [x.min(), y.min(), z.min()])
+            maxs = np.maximum(maxs, [x.max(), y.max(), z.max()])
+
+            # count the points of the occupied cells only, the grid can be much larger than the chunk
+            ix = np.clip(((x - header.x_min) / density_cell_size).astype(np.int64), 0, nr_cells[0] - 1)
+            iy = np.clip(((y - header.y_min) / density_cell_size).astype(np.int64), 0, nr_cells[1] - 1)
+            cells, cell_counts = np.unique(ix * nr_cells[1] + iy, return_counts=True)
+            density[cells] += cell_counts
+
+            z_histogram += np.histogram(np.clip(z, z_bins[0], z_bins[-1]), bins=z_bins)[0]
+            intensity_histogram += np.histogram(np.asarray(points.intensity), bins=intensity_bins)[0]
+            classification_counts += np.bincount(np.asarray(points.classification), minlength=256)[0:256]
+
+            if has_rgb:
+                nr_colored_points += int(np.count_nonzero(np.asarray(points.red) | np.asarray(points.green) |
+                                                          np.asarray(points.blue)))
+            if 'gps_time' in dimension_names:
+                nr_points_with_gps_time += int(np.count_nonzero(np.asarray(points.gps_time)))
+
+    density = density.reshape(nr_cells[0], nr_cells[1])
+    nr_occupied_cells = int(np.count_nonzero(density))
+
+    stat = os.stat(file_path)
+    profile = {"file_name": os.path.basename(file_path),
+               "source_size": stat.st_size,
+               "source_mtime_ns": stat.st_mtime_ns,
+               "point_format": header.point_format.id,
+               "version": str(header.version),
+               "scales": header.scales.tolist(),
+               "offsets": header.offsets.tolist(),
+               "dimension_names": dimension_names,
+               "point_count": point_count,
+               "header_point_count": header.point_count,
+               "min": mins.tolist() if point_count > 0 else header.mins.tolist(),
+               "max": maxs.tolist() if point_count > 0 else header.maxs.tolist(),
+               "has_color": bool(nr_colored_points > 0),
+               "nr_colored_points": nr_colored_points,
+               "has_gps_time": bool(nr_points_with_gps_time > 0),
+               "classification_counts": {str(c): int(classification_counts[c])
+                                         for c in np.flatnonzero(classification_counts)},
+               "z_histogram": {"bins": z_bins.tolist(), "counts": z_histogram.tolist()},
+               "intensity_histogram": {"bins": intensity_bins.tolist(), "counts": intensity_histogram.tolist()},
+               "density": {"cell_size": density_cell_size,
+                           "requested_cell_size": cell_size,
+                           "origin": [header.x_min, header.y_min],
+                           "shape": nr_cells.tolist(),
+                           "nr_occupied_cells": nr_occupied_cells,
+                           "mean_points_per_m2": (point_count / (nr_occupied_cells * density_cell_size ** 2)
+                                                  if nr_occupied_cells > 0 else 0.0),
+                           "max_points_per_m2": float(density.max()) / density_cell_size ** 2}}
+
+    file_path_profile, file_path_density = get_profile_file_paths(file_path)
+    with open(file_path_profile, 'w') as f:
+        json.dump(profile, f, indent=4)
+    np.save(file_path_density, density)
+
+    print(f"   file {os.path.basename(file_path)} profiled: {point_count} points, "
+          f"{len(profile['classification_counts'])} classes, color {'present' if profile['has_color'] else 'missing'}")
 
-    if file_cntr == 0:
+    return profile
+
+
+def read_pointcloud_profile(file_path: str) -> dict:
+    """
+    Returns the cached profile of the pointcloud or None if there is none or the pointcloud changed after profiling
+    """
+
+    file_path_profile = get_profile_file_paths(file_path)[0]
+    if not os.path.isfile(file_path_profile):
+        return None
+
+    with open(file_path_profile, 'r') as f:
+        profile = json.load(f)
+
+    stat = os.stat(file_path)
+    if stat.st_size != profile["source_size"] or stat.st_mtime_ns != profile["source_mtime_ns"]:
+        return None
+
+    return profile
+
+
+def get_pointcloud_profile(file_path: str, chunk_size: int = 1_000_000, cell_size: float = 1.0) -> dict:
+    """
+    Returns the cached profile of the pointcloud, the pointcloud is profiled if the cache is missing or outdated
+    """
+
+    profile = read_pointcloud_profile(file_path)
+    if profile is None or profile["density"].get("requested_cell_size", profile["density"]["cell_size"]) != cell_size:
+        profile = profile_pointcloud(file_path, chunk_size, cell_size)
+
+    return profile
+
+
+def read_density_grid(file_path: str) -> np.array:
+    """
+    Returns the cached density grid of the pointcloud with the point count per cell, indexed by [ix, iy]
+    """
+
+    return np.load(get_profile_file_paths(file_path)[1])
+
+
+def get_dimension_names(file_path: str) -> list:
+    """
+    Returns the dimension names of the pointcloud from the cached profile or, without a profile, from the header
+    """
+
+    profile = read_pointcloud_profile(file_path)
+    if profile is not None:
+        return profile["dimension_names"]
+
+    with open_pointcloud(file_path) as reader:
+        return list(reader.header.point_format.dimension_names)
+
+
+def check_pointcloud_dimensions(file_path: str, dimension_names: tuple) -> None:
+    """
+    Raises a ValueError if the pointcloud lacks any of the dimensions, without reading its points
+    """
+
+    missing_dimension_names = [name for name in dimension_names if name not in get_dimension_names(file_path)]
+    if len(missing_dimension_names) > 0:
+        raise ValueError(f"{os.path.basename(file_path)} has no dimensions {missing_dimension_names}")
+
+
+def get_output_file_name(file_name: str, output_format: str = None) -> str:
+    """
+    Returns the file name with the extension of the output format, None keeps the format of the file
+    """
+
+    if output_format is None:
+        return file_name
+
+    if output_format not in POINTCLOUD_FORMATS:
+        raise ValueError(f"get_output_file_name(): output_format must be one of {POINTCLOUD_FORMATS}")
+
+    return os.path.splitext(file_name)[0] + "." + output_format
+
+
+def transform_pointclouds(path: str,
+                          t: np.array = np.identity(4),
+                          num_workers: int = 1,
+                          chunk_size: int = None,
+                          lossless: bool = False,
+                          output_format: str = None,
+                          raise_errors: bool = True) -> dict:
+    """
+    Transforms the pointclouds in *.las or *.laz format in the given folder and stores them in the subdirectory
+    transformed. With num_workers > 1 the files are transformed concurrently in a process pool, the calling script
+    needs an if __name__ == '__main__': guard since the workers import it.
+    output_format selects 'las' or 'laz' for the transformed files, None keeps the format of every file.
+    The failed files are reported after all files were processed and with raise_errors a RuntimeError is raised.
+    Returns a dictionary with the error message of every file, None if the file was transformed successfully.
+    """
+
+    file_names = [file_name for file_name in sorted(os.listdir(os.path.join(path, "pointclouds")))
+                  if file_name.lower().endswith(POINTCLOUD_EXTENSIONS)]
+
+    if len(file_names) == 0:
         print(textcolor.colored_text("   no pointclouds found in the folder!", "Red"))
+        return {}
+
+    # create the subdirectory before the workers start
+    helper.create_subdir_if_not_exists(os.path.join(path, "pointclouds"), "transformed")
+
+    results = {}
+    if num_workers > 1 and len(file_names) > 1:
+        # spawn the workers, forking a process that already runs laz compression threads can dead lock
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(file_names)),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            futures = {executor.submit(try_transform_pointcloud, path, file_name, t, chunk_size, lossless,
+                                       output_format): file_name
+                       for file_name in file_names}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    else:
+        for file_name in file_names:
+            results[file_name] = try_transform_pointcloud(path, file_name, t, chunk_size, lossless,
+                                                          output_format)
+
+    # report the files that failed
+    nr_failed = 0
+    for file_name in file_names:
+        if results[file_name] is not None:
+            nr_failed += 1
+            print(textcolor.colored_text(f"   file {file_name} failed: {results[file_name]}", "Red"))
+    print(f"   {len(file_names) - nr_failed} of {len(file_names)} pointclouds transformed")
+
+    if raise_errors and nr_failed > 0:
+        raise RuntimeError(f"transform_pointclouds(): {nr_failed} of {len(file_names)} pointclouds failed")
+
+    return {file_name: results[file_name] for file_name in file_names}
+
+
+def try_transform_pointcloud(path: str,
+                             file_name: str,
+                             t: np.array = np.identity(4),
+                             chunk_size: int = None,
+                             lossless: bool = False,
+                             output_format: str = None) -> str:
+    """
+    Transforms the pointcloud file_name and returns None on success or the error message if it failed
+    """
+
+    try:
+        transform_pointcloud(path, file_name, t, chunk_size, lossless, output_format)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+
+    return None
+
+
+def get_transformed_extent(header: laspy.LasHeader, t: np.array) -> (np.array, np.array):
+    """
+    Returns the minimum and maximum of the bounding box of the header extent transformed by t
+    """
+
+    corners = np.array([[x, y, z] for x in (header.x_min, header.x_max)
+                        for y in (header.y_min, header.y_max)
+                        for z in (header.z_min, header.z_max)])
+    corners = transformations.apply_transformation_to_points(corners, t)
+
+    return corners.min(axis=0), corners.max(axis=0)
+
+
+def get_scale_for_extent(scale: float, offset: float, extent_min: float, extent_max: float) -> float:
+    """
+    Returns the given scale if the extent can be stored as 32 bit integers with the offset, otherwise the smallest
+    power of 10 times the scale that can store it
+    """
+
+    int32_info = np.iinfo(np.int32)
+    while max(abs(extent_max - offset), abs(extent_min - offset)) / scale >= int32_info.max:
+        scale *= 10.0
+
+    return scale
 
 
-def transform_pointcloud(path: str, file_name: str, t: np.array = np.identity(4)) -> None:
+def create_header_for_transformation(header: laspy.LasHeader, t: np.array) -> laspy.LasHeader:
     """
-    Transforms the pointcloud file_name in *.las format in the given folder and stores them in the subdirectory transformed
+    Returns a copy of the header with offsets and scales chosen for the transformed extent, the point format with
+    all dimensions and extra bytes as well as the vlrs are kept
+    """
+
+    header_transformed = copy.deepcopy(header)
+    transformed_min, transformed_max = get_transformed_extent(header, t)
+    offsets = np.floor(transformed_min)
+    scales = np.array([get_scale_for_extent(header.scales[i], offsets[i], transformed_min[i], transformed_max[i])
+                       for i in range(3)])
+    if np.any(scales != header.scales):
+        print(textcolor.colored_text(f"   scales changed from {header.scales} to {scales} to store the "
+                                     f"transformed extent", "Orange"))
+    header_transformed.offsets = offsets
+    header_transformed.scales = scales
+
+    return header_transformed
+
+
+def transform_points_to_integer_coordinates(points: laspy.ScaleAwarePointRecord,
+                                            t: np.array,
+                                            header: laspy.LasHeader) -> None:
+    """
+    Transforms the coordinates of the points in place and stores them as integer coordinates
+    in the scales and offsets of the given header, all other dimensions are left untouched
+    """
+
+    xyz = np.empty((len(points), 3))
+    xyz[:, 0] = points.x
+    xyz[:, 1] = points.y
+    xyz[:, 2] = points.z
+
+    # rotate and translate in place
+    transformations.apply_transformation_to_points(xyz, t, in_place=True)
+
+    # express the points in the scales and offsets of the header
+    xyz -= header.offsets
+    xyz /= header.scales
+    np.rint(xyz, out=xyz)
+    points.offsets = header.offsets
+    points.scales = header.scales
+    points.X = xyz[:, 0]
+    points.Y = xyz[:, 1]
+    points.Z = xyz[:, 2]
+
+
+def transform_pointcloud_lossless(file_path: str,
+                                  file_path_transformed: str,
+                                  t: np.array) -> None:
+    """
+    Transforms the pointcloud in file_path and writes it to file_path_transformed, the source point records are kept
+    with all dimensions and only the integer coordinates are rewritten for the transformed extent
+    """
+
+    las = read_pointcloud(file_path)
+    header = create_header_for_transformation(las.header, t)
+
+    transform_points_to_integer_coordinates(las.points, t, header)
+
+    las_transformed = laspy.LasData(header=header, points=las.points)
+    las_transformed.write(file_path_transformed, do_compress=file_path_transformed.lower().endswith('.laz'),
+                          laz_backend=get_laz_backend())
+
+
+def transform_pointcloud_in_chunks(file_path: str,
+                                   file_path_transformed: str,
+                                   t: np.array,
+                                   chunk_size: int = 1_000_000) -> None:
+    """
+    Transforms the pointcloud in file_path chunk by chunk and writes it to file_path_transformed,
+    memory is bounded by the chunk size and all point dimensions, vlrs and evlrs are kept
+    """
+
+    with open_pointcloud(file_path) as reader:
+        header = create_header_for_transformation(reader.header, t)
+
+        with laspy.open(file_path_transformed, mode='w', header=header,
+                        do_compress=file_path_transformed.lower().endswith('.laz'),
+                        laz_backend=get_laz_backend()) as writer:
+            for points in reader.chunk_iterator(chunk_size):
+                transform_points_to_integer_coordinates(points, t, header)
+                writer.write_points(points)
+
+            # the evlrs of the source follow the points
+            if header.evlrs:
+                writer.write_evlrs(header.evlrs)
+
+
+def transform_pointcloud(path: str,
+                         file_name: str,
+                         t: np.array = np.identity(4),
+                         chunk_size: int = None,
+                         lossless: bool = False,
+                         output_format: str = None) -> None:
+    """
+    Transforms the pointcloud file_name in *.las or *.laz format in the given folder and stores them in the subdirectory transformed.
+    If chunk_size is given the pointcloud is streamed with chunk_size points at a time instead of being loaded at once.
+    With lossless the source point records are kept with all dimensions, vlrs and evlrs and the header scales
+    and offsets are chosen for the transformed extent, the streamed transformation is lossless as well.
+    output_format selects 'las' or 'laz' for the transformed file, None keeps the format of file_name.
     """
 
     path = os.path.join(path, "pointclouds")
@@ -37,16 +452,30 @@ def transform_pointcloud(path: str, file_name: str, t: np.array = np.identity(4)
         print(f"   no {file_name} file was found")
         return
 
+    file_name_transformed = get_output_file_name(file_name, output_format)
+
+    if chunk_size is not None:
+        transform_pointcloud_in_chunks(os.path.join(path, file_name), os.path.join(path_sub_dir, file_name_transformed),
+                                       t, chunk_size)
+        print(f"   file {file_name} transformed and saved as {file_name_transformed}")
+        return
+
+    if lossless:
+        transform_pointcloud_lossless(os.path.join(path, file_name), os.path.join(path_sub_dir, file_name_transformed), t)
+        print(f"   file {file_name} transformed and saved as {file_name_transformed}")
+        return
+
+    # fail before loading the LAS file if the dimensions copied below are missing
+    check_pointcloud_dimensions(os.path.join(path, file_name), LEGACY_DIMENSIONS)
+
     # load the LAS file
-    las = laspy.read(os.path.join(path, file_name))
+    las = read_pointcloud(os.path.join(path, file_name))
     
     # extract point coordinates
     points = np.vstack((las.x, las.y, las.z)).transpose()
 
     # apply the transformation to each point
-    points_h = np.hstack((points, np.ones((points.shape[0], 1))))
-    transformed_points_h = points_h @ t.T
-    transformed_points = transformed_points_h[:, :3]
+    transformed_points = transformations.apply_transformation_to_points(points, t, in_place=True)
 
     # create a new LAS file and write the transformed points
     header = las.header
@@ -75,10 +504,11 @@ def transform_pointcloud(path: str, file_name: str, t: np.array = np.identity(4)
         las_transformed.green = las.green
         las_transformed.blue = las.blue
 
-    file_was_found = helper.does_file_name_exist_in_path(path_sub_dir, file_name)
+    file_was_found = helper.does_file_name_exist_in_path(path_sub_dir, file_name_transformed)
     if file_was_found:
-        os.remove(os.path.join(path_sub_dir, file_name))
+        os.remove(os.path.join(path_sub_dir, file_name_transformed))
 
     # save the new LAS file
-    las_transformed.write(os.path.join(path_sub_dir, file_name))
-    print(f"   file {file_name} transformed and saved")
+    las_transformed.write(os.path.join(path_sub_dir, file_name_transformed),
+                          do_compress=file_name_transformed.lower().endswith('.laz'), laz_backend=get_laz_backend())
+    print(f"   file {file_name} transformed and saved as {file_name_transformed}")
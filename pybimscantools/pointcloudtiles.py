@@ -0,0 +1,303 @@
+""" This file contains functions to reorganise a pointcloud into a quadtree of tile files
+with a metadata index and to query the points within a bounding box or a polygon
+by reading only the tiles that are needed
+"""
+
+import copy
+import json
+import os
+from collections import OrderedDict
+
+import laspy
+import matplotlib.path as mpltPath
+import numpy as np
+from matplotlib.transforms import Bbox
+
+from pybimscantools import coordinatelist as cl
+from pybimscantools import helper
+from pybimscantools import pointcloud
+from pybimscantools import textcolor
+
+
+TILE_INDEX_FILE_NAME = 'tile_index.json'
+MAX_TILE_LEVEL = 10
+MAX_OPEN_TILE_FILES = 64
+
+
+def get_tiles_path(path: str, file_name: str, do_use_transformed_pointcloud: bool = False) -> str:
+    """
+    Returns the directory of the tiles of the pointcloud file_name
+    """
+
+    path = os.path.join(path, "pointclouds")
+    if do_use_transformed_pointcloud:
+        path = os.path.join(path, "transformed")
+
+    return os.path.join(path, "tiles", os.path.splitext(file_name)[0])
+
+
+def get_cell_indices(x: np.array, y: np.array, root_bounds: list, nr_cells: int) -> (np.array, np.array):
+    """
+    Returns the column and row of the finest quadtree cells containing the points
+    """
+
+    cell_size = (root_bounds[2] - root_bounds[0]) / nr_cells
+    ix = np.clip(((x - root_bounds[0]) / cell_size).astype(np.int64), 0, nr_cells - 1)
+    iy = np.clip(((y - root_bounds[1]) / cell_size).astype(np.int64), 0, nr_cells - 1)
+
+    return ix, iy
+
+
+def build_quadtree(counts: np.array, root_bounds: list, max_points_per_tile: int) -> (list, np.array):
+    """
+    Splits the square root_bounds recursively into 4 children as long as a node contains more than
+    max_points_per_tile points. counts holds the number of points of the finest cells.
+    Returns the list of leaf tiles and a map from the finest cells to the tile index.
+    """
+
+    nr_cells = counts.shape[0]
+    max_level = int(np.log2(nr_cells))
+    root_size = root_bounds[2] - root_bounds[0]
+
+    # counts per node of every level, level 0 is the root
+    level_counts = [counts]
+    for _ in range(max_level):
+        c = level_counts[0]
+        level_counts.insert(0, c.reshape(c.shape[0] // 2, 2, c.shape[1] // 2, 2).sum(axis=(1, 3)))
+
+    tiles = []
+    cell_to_tile = np.full((nr_cells, nr_cells), -1, dtype=np.int32)
+    nodes = [(0, 0, 0)]
+    while nodes:
+        level, ix, iy = nodes.pop()
+        point_count = int(level_counts[level][ix, iy])
+        if point_count == 0:
+            continue
+
+        if point_count > max_points_per_tile and level < max_level:
+            for dx in (0, 1):
+                for dy in (0, 1):
+                    nodes.append((level + 1, 2 * ix + dx, 2 * iy + dy))
+            continue
+
+        node_size = root_size / 2 ** level
+        cells_per_node = nr_cells // 2 ** level
+        cell_to_tile[ix * cells_per_node:(ix + 1) * cells_per_node,
+                     iy * cells_per_node:(iy + 1) * cells_per_node] = len(tiles)
+        tiles.append({"file_name": f"tile_{level}_{ix}_{iy}.las",
+                      "level": level,
+                      "ix": ix,
+                      "iy": iy,
+                      "bounds": [root_bounds[0] + ix * node_size, root_bounds[1] + iy * node_size,
+                                 root_bounds[0] + (ix + 1) * node_size, root_bounds[1] + (iy + 1) * node_size],
+                      "point_count": point_count})
+
+    return tiles, cell_to_tile
+
+
+def close_tile_writer(writer, evlrs: list) -> None:
+    """
+    Closes the writer of a tile, a newly written tile gets the evlrs of the source after its points,
+    appending to the tile later keeps them
+    """
+
+    if isinstance(writer, laspy.LasWriter) and evlrs:
+        writer.write_evlrs(evlrs)
+    writer.close()
+
+
+def create_tiles(path: str,
+                 file_name: str,
+                 max_points_per_tile: int = 2_000_000,
+                 min_tile_size: float = 5.0,
+                 chunk_size: int = 1_000_000,
+                 do_use_transformed_pointcloud: bool = False,
+                 max_open_files: int = MAX_OPEN_TILE_FILES) -> dict:
+    """
+    Reorganises the pointcloud file_name into a quadtree of *.las tiles in the subdirectory tiles/<name> and writes
+    a tile_index.json with the bounds and point counts of every tile. A tile is split as long as it contains more
+    than max_points_per_tile points and is larger than min_tile_size. The pointcloud is streamed twice with
+    chunk_size points at a time, the first pass counts the points, the second one writes the tiles. At most
+    max_open_files tiles are open at a time, the least recently written tile is closed and appended to later.
+    """
+
+    path_pointcloud = os.path.join(path, "pointclouds")
+    if do_use_transformed_pointcloud:
+        path_pointcloud = os.path.join(path_pointcloud, "transformed")
+
+    if not helper.does_file_name_exist_in_path(path_pointcloud, file_name):
+        print(f"   no {file_name} file was found")
+        return None
+
+    file_path = os.path.join(path_pointcloud, file_name)
+    path_tiles = get_tiles_path(path, file_name, do_use_transformed_pointcloud)
+    os.makedirs(path_tiles, exist_ok=True)
+    for old_file_name in os.listdir(path_tiles):
+        if old_file_name.startswith("tile_") or old_file_name == TILE_INDEX_FILE_NAME:
+            os.remove(os.path.join(path_tiles, old_file_name))
+
+    with pointcloud.open_pointcloud(file_path) as reader:
+        header = reader.header
+
+        # the quadtree root is the square around the header extent
+        root_size = max(header.x_max - header.x_min, header.y_max - header.y_min, min_tile_size)
+        root_bounds = [header.x_min, header.y_min, header.x_min + root_size, header.y_min + root_size]
+        max_level = int(np.clip(np.ceil(np.log2(root_size / min_tile_size)), 0, MAX_TILE_LEVEL))
+        nr_cells = 2 ** max_level
+
+        # first pass: count the points of the finest cells
+        counts = np.zeros(nr_cells * nr_cells, dtype=np.int64)
+        for points in reader.chunk_iterator(chunk_size):
+            ix, iy = get_cell_indices(points.x, points.y, root_bounds, nr_cells)
+            counts += np.bincount(ix * nr_cells + iy, minlength=nr_cells * nr_cells)
+
+    tiles, cell_to_tile = build_quadtree(counts.reshape(nr_cells, nr_cells), root_bounds, max_points_per_tile)
+
+    # second pass: write the points tile by tile, the tiles keep the header of the source
+    writers = OrderedDict()  # the least recently written tile first
+    is_created = np.zeros(len(tiles), dtype=bool)
+    z_min = np.full(len(tiles), np.inf)
+    z_max = np.full(len(tiles), -np.inf)
+    try:
+        with pointcloud.open_pointcloud(file_path) as reader:
+            tile_header = copy.deepcopy(reader.header)
+            for points in reader.chunk_iterator(chunk_size):
+                ix, iy = get_cell_indices(points.x, points.y, root_bounds, nr_cells)
+                tile_nr = cell_to_tile[ix, iy]
+                z = np.asarray(points.z)
+
+                order = np.argsort(tile_nr, kind='stable')
+                tile_nrs, starts = np.unique(tile_nr[order], return_index=True)
+                ends = np.append(starts[1:], len(order))
+                for tile_i, start, end in zip(tile_nrs, starts, ends):
+                    indices = order[start:end]
+                    writer = writers.pop(tile_i, None)
+                    if writer is None:
+                        if len(writers) >= max_open_files:
+                            close_tile_writer(writers.popitem(last=False)[1], tile_header.evlrs)
+                        tile_file_path = os.path.join(path_tiles, tiles[tile_i]["file_name"])
+                        if is_created[tile_i]:
+                            writer = laspy.open(tile_file_path, mode='a')
+                        else:
+                            writer = laspy.open(tile_file_path, mode='w', header=tile_header)
+                            is_created[tile_i] = True
+                    writers[tile_i] = writer
+
+                    if isinstance(writer, laspy.LasWriter):
+                        writer.write_points(points[indices])
+                    else:
+                        writer.append_points(points[indices])
+                    z_min[tile_i] = min(z_min[tile_i], z[indices].min())
+                    z_max[tile_i] = max(z_max[tile_i], z[indices].max())
+    finally:
+        for writer in writers.values():
+            close_tile_writer(writer, tile_header.evlrs)
+
+    for tile_i, tile in enumerate(tiles):
+        tile["z_min"] = float(z_min[tile_i])
+        tile["z_max"] = float(z_max[tile_i])
+
+    stat = os.stat(file_path)
+    tile_index = {"source_file_name": file_name,
+                  "source_size": stat.st_size,
+                  "source_mtime_ns": stat.st_mtime_ns,
+                  "point_count": int(counts.sum()),
+                  "root_bounds": root_bounds,
+                  "max_level": max_level,
+                  "max_points_per_tile": max_points_per_tile,
+                  "tiles": tiles}
+    with open(os.path.join(path_tiles, TILE_INDEX_FILE_NAME), 'w') as f:
+        json.dump(tile_index, f, indent=4)
+
+    print(f"   file {file_name} split into {len(tiles)} tiles")
+
+    return tile_index
+
+
+def read_tile_index(path: str, file_name: str, do_use_transformed_pointcloud: bool = False) -> dict:
+    """
+    Reads the tile_index.json of the pointcloud file_name, warns if the pointcloud changed after tiling
+    """
+
+    path_tiles = get_tiles_path(path, file_name, do_use_transformed_pointcloud)
+    with open(os.path.join(path_tiles, TILE_INDEX_FILE_NAME), 'r') as f:
+        tile_index = json.load(f)
+
+    file_path = os.path.join(os.path.dirname(os.path.dirname(path_tiles)), file_name)
+    if os.path.isfile(file_path):
+        stat = os.stat(file_path)
+        if stat.st_size != tile_index["source_size"] or stat.st_mtime_ns != tile_index["source_mtime_ns"]:
+            print(textcolor.colored_text(f"   {file_name} changed after tiling, the tiles are outdated", "Orange"))
+
+    return tile_index
+
+
+def get_polygon_from_coordinates(polygon) -> np.array:
+    """
+    Returns the xy coordinates of a CoordinateList or of a Nx2 or Nx3 array as a Nx2 array
+    """
+
+    if isinstance(polygon, cl.CoordinateList):
+        polygon = polygon.get_array()
+
+    return np.asarray(polygon, dtype=np.float64)[:, 0:2]
+
+
+def query_tiles(path: str,
+                file_name: str,
+                bbox: list = None,
+                polygon=None,
+                do_use_transformed_pointcloud: bool = False) -> laspy.LasData:
+    """
+    Returns the points of the tiled pointcloud file_name within the bounding box [x_min, y_min, x_max, y_max]
+    and/or within the polygon given as CoordinateList (e.g. a footprint from ISOCoC) or as Nx2 array.
+    Only the tiles that intersect the query are read.
+    """
+
+    tile_index = read_tile_index(path, file_name, do_use_transformed_pointcloud)
+    path_tiles = get_tiles_path(path, file_name, do_use_transformed_pointcloud)
+
+    polygon_path = None
+    if polygon is not None:
+        polygon_xy = get_polygon_from_coordinates(polygon)
+        polygon_path = mpltPath.Path(np.vstack((polygon_xy, polygon_xy[0])), closed=True)
+        polygon_bbox = [*polygon_xy.min(axis=0), *polygon_xy.max(axis=0)]
+        if bbox is None:
+            bbox = polygon_bbox
+        else:
+            bbox = [max(bbox[0], polygon_bbox[0]), max(bbox[1], polygon_bbox[1]),
+                    min(bbox[2], polygon_bbox[2]), min(bbox[3], polygon_bbox[3])]
+
+    header = None
+    arrays = []
+    for tile in tile_index["tiles"]:
+        tile_bounds = tile["bounds"]
+        if bbox is not None and (tile_bounds[0] > bbox[2] or tile_bounds[2] < bbox[0] or
+                                 tile_bounds[1] > bbox[3] or tile_bounds[3] < bbox[1]):
+            continue
+        if polygon_path is not None and not polygon_path.intersects_bbox(Bbox.from_extents(*tile_bounds),
+                                                                         filled=True):
+            continue
+
+        las = laspy.read(os.path.join(path_tiles, tile["file_name"]))
+        if header is None:
+            header = las.header
+
+        mask = np.ones(len(las.points), dtype=bool)
+        x = np.asarray(las.x)
+        y = np.asarray(las.y)
+        if bbox is not None:
+            mask &= (x >= bbox[0]) & (x <= bbox[2]) & (y >= bbox[1]) & (y <= bbox[3])
+        if polygon_path is not None and np.any(mask):
+            mask[mask] = polygon_path.contains_points(np.column_stack((x[mask], y[mask])))
+        arrays.append(las.points.array[mask])
+
+    if header is None:
+        print(textcolor.colored_text("   no tiles intersect the query", "Orange"))
+        return None
+
+    points = laspy.ScaleAwarePointRecord(np.concatenate(arrays), header.point_format, header.scales, header.offsets)
+    las_query = laspy.LasData(header=copy.deepcopy(header), points=points)
+    las_query.update_header()
+
+    return las_query
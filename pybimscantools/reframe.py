@@ -0,0 +1,66 @@
+""" This file contains the batched reframing of coordinate arrays between LV95 and ETRF93
+with a swissreframe backend that is initialised once per process
+"""
+
+import threading
+
+import numpy as np
+from swissreframe import initialize_reframe
+
+
+LV95_TO_ETRF93_GEOGRAPHIC = 'lv95_to_etrf93_geographic'
+LV95_TO_ETRF93_GEOCENTRIC = 'lv95_to_etrf93_geocentric'
+ETRF93_GEOGRAPHIC_TO_LV95 = 'etrf93_gepgraphic_to_lv95'
+ETRF93_GEOCENTRIC_TO_LV95 = 'etrf93_geocentric_to_lv95'
+
+_swiss_ref = None
+_swiss_ref_lock = threading.Lock()
+
+
+def get_reframe():
+    """
+    Returns the swissreframe backend, it is initialised on the first call and cached for the process
+    """
+
+    global _swiss_ref
+    with _swiss_ref_lock:
+        if _swiss_ref is None:
+            _swiss_ref = initialize_reframe()
+
+    return _swiss_ref
+
+
+def transform_coordinates(coordinates: np.array, transformation: str) -> np.array:
+    """
+    Returns the Nx3 array of coordinates transformed with the swissreframe transformation,
+    every distinct coordinate is transformed only once
+    """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+    if len(coordinates) == 0:
+        return coordinates.copy()
+
+    # closed polygons and neighbouring buildings share many vertices
+    unique_coordinates, inverse = np.unique(coordinates, axis=0, return_inverse=True)
+
+    swiss_ref = get_reframe()
+    with _swiss_ref_lock:
+        transformed_coordinates = np.array([swiss_ref.compute_gpsref(coordinate, transformation)
+                                            for coordinate in unique_coordinates.tolist()], dtype=np.float64)
+
+    return transformed_coordinates[inverse.reshape(-1)]
+
+
+def transform_coordinate_arrays(coordinate_arrays: list, transformation: str) -> list:
+    """
+    Returns the Nx3 arrays of coordinates transformed with the swissreframe transformation in one batch
+    """
+
+    if len(coordinate_arrays) == 0:
+        return []
+
+    lengths = [len(coordinates) for coordinates in coordinate_arrays]
+    transformed_coordinates = transform_coordinates(np.vstack([np.asarray(coordinates).reshape(-1, 3)
+                                                               for coordinates in coordinate_arrays]), transformation)
+
+    return np.split(transformed_coordinates, np.cumsum(lengths)[:-1])
@@ -0,0 +1,324 @@
+""" This file contains the simplification of footprint polygons stored in CoordinateLists and CoordinateModels
+with Douglas-Peucker or Visvalingam-Whyatt, a vertex budget per polygon and a report of the introduced error
+"""
+
+import heapq
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from pybimscantools import coordinatelist as cl
+from pybimscantools import coordinatemodel as cm
+from pybimscantools import textcolor
+
+
+SIMPLIFICATION_METHODS = ('douglas_peucker', 'visvalingam')
+MIN_RING_VERTICES = 3
+MAX_BUDGET_ITERATIONS = 20
+
+
+def get_open_ring(coordinates: np.array) -> (np.array, bool):
+    """
+    Returns the ring without the closing vertex and whether the ring was closed
+    """
+
+    is_closed = len(coordinates) > 1 and np.array_equal(coordinates[0], coordinates[-1])
+    if is_closed:
+        return coordinates[:-1], True
+
+    return coordinates, False
+
+
+def get_distances_to_segment(xy: np.array, start: np.array, end: np.array) -> np.array:
+    """
+    Returns the distances of the points to the segment from start to end
+    """
+
+    direction = end - start
+    length_squared = direction @ direction
+    if length_squared == 0.0:
+        return np.linalg.norm(xy - start, axis=1)
+
+    s = np.clip((xy - start) @ direction / length_squared, 0.0, 1.0)
+
+    return np.linalg.norm(xy - (start + s[:, None] * direction), axis=1)
+
+
+def douglas_peucker_mask(xy: np.array, tolerance: float) -> np.array:
+    """
+    Returns the mask of the vertices of the open ring xy kept by Douglas-Peucker with the given tolerance,
+    the ring is split at its first vertex and the vertex farthest from it
+    """
+
+    nr_vertices = len(xy)
+    keep = np.zeros(nr_vertices, dtype=bool)
+    if nr_vertices <= MIN_RING_VERTICES:
+        keep[:] = True
+        return keep
+
+    farthest = int(np.argmax(np.linalg.norm(xy - xy[0], axis=1)))
+    keep[[0, farthest]] = True
+
+    # closing the ring makes the last segment end at the first vertex again
+    xy_closed = np.vstack((xy, xy[0:1]))
+    segments = [(0, farthest), (farthest, nr_vertices)]
+    while segments:
+        start, end = segments.pop()
+        if end - start < 2:
+            continue
+        distances = get_distances_to_segment(xy_closed[start + 1:end], xy_closed[start], xy_closed[end])
+        i = int(np.argmax(distances))
+        if distances[i] > tolerance:
+            keep[start + 1 + i] = True
+            segments.append((start, start + 1 + i))
+            segments.append((start + 1 + i, end))
+
+    return keep
+
+
+def get_triangle_areas(xy: np.array, previous: np.array, following: np.array) -> np.array:
+    """
+    Returns the areas of the triangles formed by every vertex with its previous and following vertex
+    """
+
+    a = xy[previous]
+    c = xy[following]
+
+    return 0.5 * np.abs((xy[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) - (c[:, 0] - a[:, 0]) * (xy[:, 1] - a[:, 1]))
+
+
+def get_triangle_area(a: np.array, b: np.array, c: np.array) -> float:
+    """
+    Returns the area of the triangle a, b, c
+    """
+
+    return 0.5 * abs((b[0] - a[0]) * (c[1] - a[1]) - (c[0] - a[0]) * (b[1] - a[1]))
+
+
+def visvalingam_effective_areas(xy: np.array) -> np.array:
+    """
+    Returns the effective area of every vertex of the open ring xy, the vertices are removed in the order of
+    increasing effective area by Visvalingam-Whyatt and the last MIN_RING_VERTICES vertices get an infinite area
+    """
+
+    nr_vertices = len(xy)
+    effective_areas = np.full(nr_vertices, np.inf)
+    if nr_vertices <= MIN_RING_VERTICES:
+        return effective_areas
+
+    previous = np.roll(np.arange(nr_vertices), 1)
+    following = np.roll(np.arange(nr_vertices), -1)
+    areas = get_triangle_areas(xy, previous, following)
+    heap = list(zip(areas.tolist(), range(nr_vertices)))
+    heapq.heapify(heap)
+
+    is_removed = np.zeros(nr_vertices, dtype=bool)
+    nr_remaining = nr_vertices
+    max_area = 0.0
+    while nr_remaining > MIN_RING_VERTICES:
+        area, i = heapq.heappop(heap)
+        if is_removed[i] or area != areas[i]:
+            continue
+
+        # the effective area never decreases so that a vertex outlives the ones removed before it
+        max_area = max(max_area, area)
+        effective_areas[i] = max_area
+        is_removed[i] = True
+        nr_remaining -= 1
+
+        p = previous[i]
+        f = following[i]
+        following[p] = f
+        previous[f] = p
+        # the neighbours get new triangles
+        for j in (p, f):
+            areas[j] = get_triangle_area(xy[previous[j]], xy[j], xy[following[j]])
+            heapq.heappush(heap, (areas[j], j))
+
+    return effective_areas
+
+
+def apply_vertex_budget(xy: np.array, keep: np.array, max_vertices: int) -> np.array:
+    """
+    Returns the mask of the kept vertices reduced to at most max_vertices by removing the kept vertices
+    with the smallest Visvalingam-Whyatt effective area
+    """
+
+    kept = np.flatnonzero(keep)
+    if max_vertices is None or len(kept) <= max_vertices:
+        return keep
+
+    effective_areas = visvalingam_effective_areas(xy[kept])
+    keep = np.zeros(len(xy), dtype=bool)
+    keep[kept[np.sort(np.argsort(-effective_areas, kind='stable')[:max(max_vertices, MIN_RING_VERTICES)])]] = True
+
+    return keep
+
+
+def simplify_ring(coordinates: np.array,
+                  tolerance: float,
+                  max_vertices: int = None,
+                  method: str = 'douglas_peucker') -> np.array:
+    """
+    Returns the simplified ring of Nx3 coordinates, the vertices are only removed and never moved.
+    Douglas-Peucker removes the vertices closer than tolerance to the simplified ring, Visvalingam-Whyatt removes
+    the vertices with an effective area smaller than tolerance^2. A closed ring stays closed.
+    """
+
+    ring, is_closed = get_open_ring(coordinates)
+    xy = ring[:, 0:2]
+    if method == 'douglas_peucker':
+        keep = douglas_peucker_mask(xy, tolerance)
+    else:
+        keep = visvalingam_effective_areas(xy) >= tolerance ** 2
+
+    # a thin ring is not collapsed to a line, the vertices with the largest effective area are kept
+    if np.count_nonzero(keep) < min(MIN_RING_VERTICES, len(xy)):
+        keep = apply_vertex_budget(xy, np.ones(len(xy), dtype=bool), MIN_RING_VERTICES)
+
+    keep = apply_vertex_budget(xy, keep, max_vertices)
+    simplified = ring[keep]
+    if is_closed:
+        simplified = np.vstack((simplified, simplified[0:1]))
+
+    return simplified
+
+
+def get_shapely_polygons(coordinate_arrays: list) -> np.array:
+    """
+    Returns the rings of Nx3 coordinates as an array of 2d shapely polygons, rings with less than 3 vertices
+    give empty polygons
+    """
+
+    return np.array([shapely.Polygon(coordinates[:, 0:2]) if len(get_open_ring(coordinates)[0]) >= 3
+                     else shapely.Polygon() for coordinates in coordinate_arrays], dtype=object)
+
+
+def get_simplification_report(original_arrays: list, simplified_arrays: list) -> pd.DataFrame:
+    """
+    Returns the number of vertices before and after the simplification, the hausdorff distance between the original
+    and the simplified boundary and the relative change of the area of every polygon
+    """
+
+    original_polygons = get_shapely_polygons(original_arrays)
+    simplified_polygons = get_shapely_polygons(simplified_arrays)
+    original_areas = shapely.area(original_polygons)
+    simplified_areas = shapely.area(simplified_polygons)
+    hausdorff_distances = shapely.hausdorff_distance(shapely.boundary(original_polygons),
+                                                     shapely.boundary(simplified_polygons))
+
+    return pd.DataFrame({"vertices_before": [len(get_open_ring(c)[0]) for c in original_arrays],
+                         "vertices_after": [len(get_open_ring(c)[0]) for c in simplified_arrays],
+                         "hausdorff_distance": hausdorff_distances,
+                         "area_change": np.divide(simplified_areas - original_areas, original_areas,
+                                                  out=np.zeros(len(original_areas)), where=original_areas > 0)})
+
+
+def get_altitudes_of_vertices(original: np.array, simplified_xy: np.array) -> np.array:
+    """
+    Returns the altitudes of the simplified vertices taken from the original vertex at the same position,
+    the mean altitude of the original vertices is used for vertices that are not found
+    """
+
+    altitudes = {(x, y): z for x, y, z in original.tolist()}
+    mean_altitude = float(np.mean(original[:, 2])) if len(original) > 0 else 0.0
+
+    return np.array([altitudes.get((x, y), mean_altitude) for x, y in simplified_xy.tolist()])
+
+
+def simplify_coverage(coordinate_arrays: list, tolerance: float, max_vertices: int = None) -> list:
+    """
+    Returns the rings simplified together as a coverage so that the edges shared by adjacent footprints are
+    simplified the same way and no gaps or overlaps are introduced. The tolerance is raised until every polygon
+    fits max_vertices, the polygons that still exceed it after MAX_BUDGET_ITERATIONS iterations are reported.
+    """
+
+    polygons = get_shapely_polygons(coordinate_arrays)
+    is_valid = ~shapely.is_empty(polygons)
+
+    simplified_polygons = polygons
+    for _ in range(MAX_BUDGET_ITERATIONS):
+        if hasattr(shapely, "coverage_simplify"):
+            simplified_polygons = polygons.copy()
+            simplified_polygons[is_valid] = shapely.coverage_simplify(polygons[is_valid], tolerance)
+        else:
+            simplified_polygons = shapely.simplify(polygons, tolerance, preserve_topology=True)
+
+        nr_vertices = shapely.get_num_coordinates(shapely.get_exterior_ring(simplified_polygons)) - 1
+        if max_vertices is None or np.all(nr_vertices[is_valid] <= max(max_vertices, MIN_RING_VERTICES)):
+            break
+        tolerance = 2.0 * tolerance if tolerance > 0 else 1e-3
+
+    if max_vertices is not None:
+        over_budget = np.flatnonzero(is_valid & (nr_vertices > max(max_vertices, MIN_RING_VERTICES)))
+        if len(over_budget) > 0:
+            print(textcolor.colored_text(f"   {len(over_budget)} polygons still exceed {max_vertices} vertices after "
+                                         f"{MAX_BUDGET_ITERATIONS} iterations: {over_budget.tolist()}", "Orange"))
+
+    simplified_arrays = []
+    for coordinates, polygon, valid in zip(coordinate_arrays, simplified_polygons, is_valid):
+        if not valid:
+            simplified_arrays.append(coordinates.copy())
+            continue
+        xy = shapely.get_coordinates(polygon.exterior)
+        ring = np.column_stack((xy, get_altitudes_of_vertices(coordinates, xy)))
+        if not get_open_ring(coordinates)[1]:
+            ring = ring[:-1]
+        simplified_arrays.append(ring)
+
+    return simplified_arrays
+
+
+def simplify_coordinate_model(coordinate_model: cm.CoordinateModel,
+                              tolerance: float = 0.1,
+                              max_vertices: int = None,
+                              method: str = 'douglas_peucker',
+                              preserve_topology: bool = False) -> (cm.CoordinateModel, pd.DataFrame):
+    """
+    Returns a simplified copy of the CoordinateModel and a report with the vertices before and after, the hausdorff
+    distance and the relative area change of every CoordinateList. method selects 'douglas_peucker' or
+    'visvalingam' with the given tolerance, max_vertices limits the number of vertices per polygon. With
+    preserve_topology the footprints are simplified together as a coverage so that adjacent footprints keep
+    their shared edges, method is then ignored and the coverage is simplified by shapely.
+    """
+
+    if method not in SIMPLIFICATION_METHODS:
+        raise ValueError(f"simplify_coordinate_model(): method must be one of {SIMPLIFICATION_METHODS}")
+
+    coordinates, offsets = coordinate_model.get_arrays()
+    coordinate_arrays = [coordinates[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    if preserve_topology:
+        if not hasattr(shapely, "coverage_simplify"):
+            print(textcolor.colored_text("   shapely >= 2.1 is needed to keep shared edges, the footprints are "
+                                         "simplified one by one", "Orange"))
+        simplified_arrays = simplify_coverage(coordinate_arrays, tolerance, max_vertices)
+    else:
+        simplified_arrays = [simplify_ring(c, tolerance, max_vertices, method) for c in coordinate_arrays]
+
+    coordinate_model_simplified = cm.CoordinateModel()
+    for coordinates_simplified, height in zip(simplified_arrays, coordinate_model.get_heights()):
+        coordinate_list = cl.CoordinateList(coordinates_simplified)
+        coordinate_list.set_height(height)
+        coordinate_model_simplified.append(coordinate_list)
+
+    report = get_simplification_report(coordinate_arrays, simplified_arrays)
+    print(f"   {int(report['vertices_before'].sum())} vertices simplified to {int(report['vertices_after'].sum())}, "
+          f"max hausdorff distance {report['hausdorff_distance'].max() if len(report) > 0 else 0.0:.3f} m")
+
+    return coordinate_model_simplified, report
+
+
+def simplify_coordinate_list(coordinate_list: cl.CoordinateList,
+                             tolerance: float = 0.1,
+                             max_vertices: int = None,
+                             method: str = 'douglas_peucker') -> (cl.CoordinateList, pd.DataFrame):
+    """
+    Returns a simplified copy of the CoordinateList and the report of simplify_coordinate_model
+    """
+
+    coordinate_model_simplified, report = simplify_coordinate_model(cm.CoordinateModel(coordinate_list.copy()),
+                                                                    tolerance, max_vertices, method)
+
+    return coordinate_model_simplified[0], report
@@ -4,6 +4,8 @@ calculate transformations between coordinate systems
 
 import json
 import os
+import threading
+from collections import deque
 
 import numpy as np
 import pandas as pd
@@ -13,6 +15,11 @@ from pybimscantools import helper
 from pybimscantools import textcolor
 
 
+# transformations loaded or solved from files, keyed by the file fingerprint
+_transformation_cache = {}
+_transformation_cache_lock = threading.Lock()
+
+
 def get_normal_to_3d_points(m: np.array) -> np.array:
     """
     Function that takes a 3xN matrix of points and returns the normal vector
@@ -118,6 +125,57 @@ def get_unit_transformation_as_rotation_and_translation() -> (np.array, np.array
     return t[0:3, 0:3], t[0:3, 3]
 
 
+def apply_transformation_to_points(points: np.array,
+                                   t: np.array,
+                                   in_place: bool = False,
+                                   chunk_size: int = 1_000_000,
+                                   use_float32: bool = False) -> np.array:
+    """
+    Function that takes a Nx3 array of points and a 4x4 transformation matrix T and returns the transformed points
+    p' = R * p + p_T. The points are transformed chunk by chunk of chunk_size points so that the temporary memory is
+    bounded, with in_place the points array is overwritten if it is a writable float array. use_float32 computes
+    and returns float32, which is only precise enough for local coordinates and not for e.g. lv95.
+    """
+    dtype = np.float32 if use_float32 else np.float64
+    t = np.asarray(t, dtype=np.float64)
+    r_transposed = t[0:3, 0:3].T.astype(dtype)
+    p = t[0:3, 3].astype(dtype)
+
+    points = np.asarray(points)
+    if points.ndim != 2 or points.shape[1] != 3:
+        raise ValueError(f"apply_transformation_to_points(): points must be Nx3, they are {points.shape}")
+
+    if in_place and points.dtype == dtype and points.flags.writeable:
+        points_transformed = points
+    else:
+        points_transformed = np.empty(points.shape, dtype=dtype)
+
+    chunk = np.empty((min(chunk_size, len(points)), 3), dtype=dtype)
+    for start in range(0, len(points), chunk_size):
+        end = min(start + chunk_size, len(points))
+        np.matmul(points[start:end].astype(dtype, copy=False), r_transposed, out=chunk[0:end - start])
+        chunk[0:end - start] += p
+        points_transformed[start:end] = chunk[0:end - start]
+
+    return points_transformed
+
+
+def apply_transformation_to_rotations(rotations: np.array, t: np.array) -> np.array:
+    """
+    Function that takes a Nx3x3 array of rotation matrices and a 4x4 transformation matrix T and returns the
+    rotation matrices expressed in the frame of T, R' = R_T * R
+    """
+    return np.matmul(np.asarray(t, dtype=np.float64)[0:3, 0:3], rotations)
+
+
+def apply_transformation_to_poses(poses: np.array, t: np.array) -> np.array:
+    """
+    Function that takes a Nx4x4 array of poses and a 4x4 transformation matrix T and returns the poses
+    expressed in the frame of T, T' = T * T_i
+    """
+    return np.matmul(np.asarray(t, dtype=np.float64), poses)
+
+
 # function that takes a file name and returns a 4x4 transformation matrix
 # the file should contain 2 sets of 4 points, the first set is
 # the reference and the second set is the model
@@ -137,7 +195,8 @@ def get_unit_transformation_as_rotation_and_translation() -> (np.array, np.array
 # ----------------------------------------------------------------------------------
 # the returned transformation matrix is such that p_R = T_RM * p_M
 def read_transformation_matrix_from_points_from_txt(path: str,
-                                                    file_name: str) -> (np.array):
+                                                    file_name: str,
+                                                    ransac_threshold: float = None) -> (np.array):
     """
     Function that takes a path and a file name and returns a 4x4 transformation matrix
     """
@@ -148,7 +207,7 @@ def read_transformation_matrix_from_points_from_txt(path: str,
 
     else:
         data = pd.read_csv(os.path.join(path, file_name), sep=" ").to_numpy()
-        r_rm, p_rm = check_and_get_transformation_from_data(file_name, data)
+        r_rm, p_rm = check_and_get_transformation_from_data(file_name, data, ransac_threshold)
 
     t_rm = np.zeros((4, 4))
     t_rm[0:3, 0:3] = r_rm
@@ -174,7 +233,8 @@ def read_transformation_matrix_from_points_from_txt(path: str,
 # the returned transformation matrix is such that p_R = T_RM * p_M
 
 def read_transformation_matrix_from_points_from_xlsx(path: str,
-                                                     file_name: str = 'points_for_transformation.xlsx') -> (np.array, np.array):
+                                                     file_name: str = 'points_for_transformation.xlsx',
+                                                     ransac_threshold: float = None) -> (np.array, np.array):
     """
     Function that takes a path and a file name and returns a 4x4 transformation matrix
     """
@@ -192,7 +252,7 @@ def read_transformation_matrix_from_points_from_xlsx(path: str,
         # data is a Nx6 matrix, resize it to a 2*Nx3 matrix
         data = np.vstack((data[:, :3], data[:, 3:]))
 
-        r_rm, p_rm = check_and_get_transformation_from_data(file_name, data)
+        r_rm, p_rm = check_and_get_transformation_from_data(file_name, data, ransac_threshold)
 
     t_rm = np.zeros((4, 4))
     t_rm[0:3, 0:3] = r_rm
@@ -203,9 +263,11 @@ def read_transformation_matrix_from_points_from_xlsx(path: str,
 
 
 def check_and_get_transformation_from_data(file_name: str,
-                                           data: np.array) -> (np.array, np.array):
+                                           data: np.array,
+                                           ransac_threshold: float = None) -> (np.array, np.array):
     """
-    Function that takes a filename and a np array and return the rotation matrix and translation vector
+    Function that takes a filename and a np array and return the rotation matrix and translation vector,
+    with a ransac_threshold the point pairs with a larger residual are rejected as outliers
     """
     is_transformation_file_ok = True
     if (data.shape[0] % 2) == 1:
@@ -223,7 +285,14 @@ def check_and_get_transformation_from_data(file_name: str,
         # kabsch algorithm
         points_r = data[0:int(data.shape[0] / 2), :]
         points_m = data[int(data.shape[0] / 2):int(data.shape[0]), :]
-        r_rm, p_rm = rigid_transform_3d(points_m.transpose(), points_r.transpose())
+        if ransac_threshold is None:
+            r_rm, p_rm = rigid_transform_3d(points_m.transpose(), points_r.transpose())
+        else:
+            r_rm, p_rm, inliers, residuals = ransac_rigid_transform_3d(points_m.transpose(), points_r.transpose(),
+                                                                       ransac_threshold)
+            for i in np.flatnonzero(~inliers):
+                print(textcolor.colored_text(f"   point pair {i} of {file_name} rejected as outlier, "
+                                             f"residual = {residuals[i]:.4f}", "Orange"))
     else:
         r_rm, p_rm = get_unit_transformation_as_rotation_and_translation()
 
@@ -315,3 +384,238 @@ def rigid_transform_3d(points_m: np.array, points_r: np.array) -> (np.array, np.
     print(f"   error norm is {error_norm}")
 
     return r, t
+
+
+def get_rigid_transformations(points_m: np.array,
+                              points_r: np.array,
+                              weights: np.array = None) -> (np.array, np.array):
+    """
+    Function that takes two BxNx3 stacks of corresponding points and optional BxN weights and returns the
+    Bx3x3 rotation matrices and Bx3 translation vectors of the weighted kabsch solutions in one batched svd,
+    p_r = r @ p_m + t for every stack
+    """
+    if weights is None:
+        weights = np.ones(points_m.shape[0:2])
+    weights = weights / np.maximum(weights.sum(axis=1, keepdims=True), np.finfo(np.float64).tiny)
+
+    # weighted centroids
+    centroid_m = np.einsum('bn,bni->bi', weights, points_m)
+    centroid_r = np.einsum('bn,bni->bi', weights, points_r)
+
+    # weighted covariances
+    h = np.einsum('bn,bni,bnj->bij', weights, points_m - centroid_m[:, None, :], points_r - centroid_r[:, None, :])
+
+    u, _, vt = np.linalg.svd(h)
+
+    # correct the reflections
+    d = np.sign(np.linalg.det(np.transpose(vt, (0, 2, 1)) @ np.transpose(u, (0, 2, 1))))
+    d[d == 0] = 1.0
+    vt[:, 2, :] *= d[:, None]
+    r = np.transpose(vt, (0, 2, 1)) @ np.transpose(u, (0, 2, 1))
+    t = centroid_r - np.einsum('bij,bj->bi', r, centroid_m)
+
+    return r, t
+
+
+def ransac_rigid_transform_3d(points_m: np.array,
+                              points_r: np.array,
+                              threshold: float = 0.05,
+                              nr_hypotheses: int = 2000,
+                              max_refinements: int = 10,
+                              seed: int = 0) -> (np.array, np.array, np.array, np.array):
+    """
+    Function that takes two 3xN matrices and returns the rotation matrix R, the translation vector t, the inlier
+    mask and the residuals of all point pairs. nr_hypotheses minimal samples of 3 point pairs are solved and scored
+    in one batch, the pairs with a residual below threshold of the best hypothesis are refined with kabsch until
+    the inlier set does not change anymore.
+    """
+    assert points_m.shape == points_r.shape
+
+    num_rows, num_cols = points_m.shape
+    if num_rows != 3:
+        raise Exception(f"   matrix A is not 3xN, it is {num_rows}x{num_cols}")
+    if num_cols < 3:
+        raise Exception(f"   at least 3 point pairs are needed, got {num_cols}")
+
+    points_m = points_m.transpose().astype(np.float64)
+    points_r = points_r.transpose().astype(np.float64)
+
+    # draw minimal samples of 3 distinct point pairs
+    rng = np.random.default_rng(seed)
+    samples = np.argsort(rng.random((nr_hypotheses, num_cols)), axis=1)[:, 0:3]
+    samples = np.unique(np.sort(samples, axis=1), axis=0)
+
+    # skip the degenerated samples with (nearly) collinear points
+    sample_m = points_m[samples]
+    extent = np.linalg.norm(points_m.max(axis=0) - points_m.min(axis=0))
+    area = np.linalg.norm(np.cross(sample_m[:, 1] - sample_m[:, 0], sample_m[:, 2] - sample_m[:, 0]), axis=1)
+    samples = samples[area > 1e-6 * max(extent, 1.0) ** 2]
+    if len(samples) == 0:
+        raise Exception("   all point pairs are collinear")
+
+    # solve and score all hypotheses at once
+    r, t = get_rigid_transformations(points_m[samples], points_r[samples])
+    residuals = np.linalg.norm(np.einsum('bij,nj->bni', r, points_m) + t[:, None, :] - points_r[None, :, :], axis=2)
+    # msac score, inliers cost their squared residual and outliers the squared threshold
+    scores = np.minimum(residuals, threshold) ** 2
+    best = int(np.argmin(scores.sum(axis=1)))
+    inliers = residuals[best] < threshold
+
+    # refine with all inliers
+    r_best, t_best = r[best], t[best]
+    for _ in range(max_refinements):
+        if np.count_nonzero(inliers) < 3:
+            break
+        r_refined, t_refined = get_rigid_transformations(points_m[None, inliers], points_r[None, inliers])
+        r_best, t_best = r_refined[0], t_refined[0]
+        residuals_best = np.linalg.norm(points_m @ r_best.T + t_best - points_r, axis=1)
+        inliers_refined = residuals_best < threshold
+        if np.array_equal(inliers_refined, inliers):
+            break
+        inliers = inliers_refined
+
+    residuals_best = np.linalg.norm(points_m @ r_best.T + t_best - points_r, axis=1)
+    print(f"   {np.count_nonzero(inliers)} of {num_cols} point pairs are inliers, "
+          f"rms of the inliers is {np.sqrt(np.mean(residuals_best[inliers] ** 2)) if np.any(inliers) else np.nan}")
+
+    return r_best, t_best.reshape(-1, 1), inliers, residuals_best
+
+
+def load_transformation(path: str,
+                        file_name: str = 'T.json',
+                        ransac_threshold: float = None) -> np.array:
+    """
+    Function that takes a path and a file name of a *.json transformation or of points for a transformation in a
+    *.xlsx or *.txt file and returns the 4x4 transformation matrix. The result is cached by the path, size and
+    modification time of the file so that a file is only read and solved again after it changed.
+    """
+    file_path = os.path.abspath(os.path.join(path, file_name))
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension not in ('.json', '.xlsx', '.txt'):
+        raise ValueError(f"load_transformation(): {file_name} is not a *.json, *.xlsx or *.txt file")
+
+    key = None
+    if os.path.isfile(file_path):
+        stat = os.stat(file_path)
+        key = (file_path, stat.st_size, stat.st_mtime_ns, ransac_threshold)
+        with _transformation_cache_lock:
+            if key in _transformation_cache:
+                return _transformation_cache[key].copy()
+
+    if extension == '.json':
+        t = read_transformation_from_json(path, file_name)
+    elif extension == '.xlsx':
+        t = read_transformation_matrix_from_points_from_xlsx(path, file_name, ransac_threshold)
+    else:
+        t = read_transformation_matrix_from_points_from_txt(path, file_name, ransac_threshold)
+
+    if key is not None:
+        with _transformation_cache_lock:
+            _transformation_cache[key] = t.copy()
+
+    return t
+
+
+def clear_transformation_cache() -> None:
+    """
+    Function that removes all cached transformations
+    """
+    with _transformation_cache_lock:
+        _transformation_cache.clear()
+
+
+class FrameGraph:
+    """
+    FrameGraph class containing named frames connected by rigid transformations, the transformation between
+    any two connected frames is composed along the shortest chain and cached so that points are transformed
+    once by the composed matrix
+    """
+
+    def __init__(self) -> None:
+        self.__edges = {}
+        self.__chains = {}
+
+    def add_transformation(self, source_frame: str, target_frame: str, t: np.array) -> None:
+        """
+        Add the transformation T with p_target = T * p_source, the inverse is added as well
+        """
+        t = np.asarray(t, dtype=np.float64)
+        self.__edges.setdefault(source_frame, {})[target_frame] = t
+        self.__edges.setdefault(target_frame, {})[source_frame] = get_inverse_transformation_matrix(t)
+        self.__chains.clear()
+
+    def add_transformation_from_file(self, source_frame: str,
+                                     target_frame: str,
+                                     path: str,
+                                     file_name: str = 'T.json',
+                                     ransac_threshold: float = None) -> None:
+        """
+        Add the transformation loaded from a *.json or solved from points in a *.xlsx or *.txt file
+        """
+        self.add_transformation(source_frame, target_frame, load_transformation(path, file_name, ransac_threshold))
+
+    def get_frames(self) -> list:
+        """
+        Return the names of all frames
+        """
+        return list(self.__edges.keys())
+
+    def get_chain(self, source_frame: str, target_frame: str) -> list:
+        """
+        Return the frames of the shortest chain from the source to the target frame
+        """
+        for frame in (source_frame, target_frame):
+            if frame not in self.__edges:
+                raise KeyError(f"FrameGraph.get_chain(): unknown frame {frame}")
+
+        previous_frames = {source_frame: None}
+        frames = deque([source_frame])
+        while frames:
+            frame = frames.popleft()
+            if frame == target_frame:
+                break
+            for next_frame in self.__edges[frame]:
+                if next_frame not in previous_frames:
+                    previous_frames[next_frame] = frame
+                    frames.append(next_frame)
+
+        if target_frame not in previous_frames:
+            raise ValueError(f"FrameGraph.get_chain(): {source_frame} and {target_frame} are not connected")
+
+        chain = [target_frame]
+        while chain[-1] != source_frame:
+            chain.append(previous_frames[chain[-1]])
+
+        return chain[::-1]
+
+    def get_transformation(self, source_frame: str, target_frame: str) -> np.array:
+        """
+        Return the composed transformation T with p_target = T * p_source
+        """
+        key = (source_frame, target_frame)
+        if key not in self.__chains:
+            chain = self.get_chain(source_frame, target_frame)
+            t = np.identity(4)
+            for frame, next_frame in zip(chain[:-1], chain[1:]):
+                t = self.__edges[frame][next_frame] @ t
+            self.__chains[key] = t
+
+        return self.__chains[key].copy()
+
+    def transform_points(self, points: np.array,
+                         source_frame: str,
+                         target_frame: str,
+                         in_place: bool = False,
+                         chunk_size: int = 1_000_000,
+                         use_float32: bool = False) -> np.array:
+        """
+        Transform the Nx3 points from the source to the target frame in a single pass with the composed transformation
+        """
+        return apply_transformation_to_points(points, self.get_transformation(source_frame, target_frame),
+                                              in_place, chunk_size, use_float32)
+
+    def transform_poses(self, poses: np.array, source_frame: str, target_frame: str) -> np.array:
+        """
+        Transform the Nx4x4 poses from the source to the target frame with the composed transformation
+        """
+        return apply_transformation_to_poses(poses, self.get_transformation(source_frame, target_frame))
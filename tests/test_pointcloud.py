@@ -0,0 +1,50 @@
+""" Tests of the transformation of pointclouds in pybimscantools.pointcloud """
+
+import os
+
+import laspy
+import numpy as np
+import pytest
+
+from pybimscantools import pointcloud
+
+
+def create_pointcloud_with_vlrs(path: str) -> laspy.LasData:
+    """
+    Writes a LAS 1.4 pointcloud with one vlr and one evlr to path/pointclouds/pointcloud.las
+    """
+
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.scales = [0.001, 0.001, 0.001]
+    header.offsets = [2600000.0, 1200000.0, 400.0]
+    header.vlrs.append(laspy.VLR("pybimscantools", 1, "vlr", b"vlr data"))
+
+    las = laspy.LasData(header)
+    rng = np.random.default_rng(0)
+    las.x = 2600000.0 + rng.random(1000) * 100.0
+    las.y = 1200000.0 + rng.random(1000) * 100.0
+    las.z = 400.0 + rng.random(1000) * 10.0
+    las.intensity = rng.integers(0, 65535, 1000)
+    las.evlrs = laspy.vlrs.vlrlist.VLRList([laspy.VLR("pybimscantools", 2, "evlr", b"evlr data")])
+
+    os.makedirs(os.path.join(path, "pointclouds"))
+    las.write(os.path.join(path, "pointclouds", "pointcloud.las"))
+
+    return las
+
+
+@pytest.mark.parametrize("options", [{"lossless": True}, {"chunk_size": 300}])
+def test_transform_pointcloud_keeps_vlrs_and_evlrs(tmp_path, options):
+    las = create_pointcloud_with_vlrs(str(tmp_path))
+    t = np.identity(4)
+    t[0:3, 3] = [-2600000.0, -1200000.0, -400.0]
+
+    pointcloud.transform_pointcloud(str(tmp_path), "pointcloud.las", t, **options)
+
+    las_transformed = laspy.read(os.path.join(tmp_path, "pointclouds", "transformed", "pointcloud.las"))
+    assert [(vlr.user_id, vlr.record_id, vlr.record_data) for vlr in las_transformed.vlrs] == \
+           [("pybimscantools", 1, b"vlr data")]
+    assert [(evlr.user_id, evlr.record_id, evlr.record_data) for evlr in las_transformed.evlrs] == \
+           [("pybimscantools", 2, b"evlr data")]
+    np.testing.assert_allclose(las_transformed.x, np.asarray(las.x) - 2600000.0, atol=1e-3)
+    np.testing.assert_array_equal(las_transformed.intensity, las.intensity)